@@ -0,0 +1,63 @@
+import logging
+import time
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
+
+from app.utils.helpers import generate_id
+from app.utils.logger import request_id_var
+
+logger = logging.getLogger(__name__)
+
+
+class LoggingMiddleware:
+    """Tag each request with an id and log its outcome and duration"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request_id = self._header(scope, b"x-request-id") or generate_id()
+        token = request_id_var.set(request_id)
+        start_time = time.perf_counter()
+        status_code = 500
+        
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message.setdefault("headers", [])
+                # Works on a copy, so the response's own header list is untouched
+                MutableHeaders(scope=message).append("x-request-id", request_id)
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration_ms = (time.perf_counter() - start_time) * 1000
+            logger.log(
+                logging.WARNING if status_code >= 500 else logging.INFO,
+                "%s %s %s %.1fms",
+                scope["method"],
+                scope["path"],
+                status_code,
+                duration_ms,
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status_code": status_code,
+                    "duration_ms": round(duration_ms, 1)
+                }
+            )
+            request_id_var.reset(token)
+    
+    @staticmethod
+    def _header(scope, name: bytes) -> Optional[str]:
+        for key, value in scope.get("headers", []):
+            if key == name:
+                return value.decode("latin-1")
+        return None
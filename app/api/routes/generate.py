@@ -1,5 +1,6 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends, Query, Header
+from typing import List, Dict, Any, Optional
+import asyncio
 import uuid
 import time
 from datetime import datetime
@@ -9,34 +10,119 @@ from app.models.schemas import (
     ImageGenerationRequest, 
     BatchGenerationRequest,
     ImageGenerationResponse,
+    SimilarImage,
+    SimilarityResponse,
     ErrorResponse
 )
+from app.config import settings
+from app.core.exceptions import (
+    SchedulerRejectedError,
+    IdempotencyConflictError,
+    IdempotencyInProgressError
+)
 from app.services.prompt_enhancer import prompt_enhancer
 from app.services.image_generator import image_generator
+from app.services.image_index import image_index
+from app.services.history_service import history_service
+from app.services.idempotency import idempotency_store
+from app.services.prewarmer import prewarmer
+from app.services.scheduler import generation_scheduler
 from app.core.database import db_manager
 from app.utils.helpers import generate_id
+from app.utils.logger import generation_id_var
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+async def save_generation_history(
+    generation_id: str,
+    user_input: Dict[str, Any],
+    enhanced_prompt: str,
+    images: List[Dict[str, Any]],
+    success: bool,
+    error_message: Optional[str],
+    generation_time_ms: int
+):
+    """Persist a generation record for the history API"""
+    await history_service.save_generation(
+        generation_id,
+        user_input,
+        enhanced_prompt,
+        images,
+        success,
+        error_message,
+        generation_time_ms
+    )
+
+async def run_idempotent(
+    idempotency_key: str,
+    user_id: str,
+    payload: Dict[str, Any],
+    operation
+):
+    """Run a generation once per Idempotency-Key, replaying stored results"""
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+    
+    try:
+        return await idempotency_store.run(idempotency_key, user_id, payload, operation)
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgressError as e:
+        raise HTTPException(
+            status_code=409,
+            detail=str(e),
+            headers={"Retry-After": str(settings.IDEMPOTENCY_POLL_INTERVAL_SECONDS)}
+        )
+
 @router.post("/single", response_model=ImageGenerationResponse)
 async def generate_single_image(
     request: ImageGenerationRequest,
-    background_tasks: BackgroundTasks
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Generate a single image based on the request"""
     
+    if not idempotency_key:
+        return await _generate_single_image(request, background_tasks)
+    
+    async def operation():
+        response = await _generate_single_image(request, background_tasks)
+        return response.dict()
+    
+    stored = await run_idempotent(
+        idempotency_key, request.user_id, request.dict(), operation
+    )
+    return ImageGenerationResponse(**stored)
+
+async def _generate_single_image(
+    request: ImageGenerationRequest,
+    background_tasks: BackgroundTasks
+) -> ImageGenerationResponse:
+    """Enhance the prompt, generate images and record the result"""
+    
     generation_id = generate_id()
+    generation_id_var.set(generation_id)
     start_time = time.time()
     
     try:
-        # Enhance prompt using knowledge base
-        enhanced_prompt = await prompt_enhancer.enhance_prompt(request.dict())
-        
-        # Generate images
-        images, generation_time = await image_generator.generate_images(
-            enhanced_prompt, generation_id
-        )
+        pooled = await prewarmer.take(request, generation_id)
+        if pooled:
+            # Served from results pre-generated during idle time
+            enhanced_prompt = pooled["enhanced_prompt"]
+            images = pooled["images"]
+            generation_time = int((time.time() - start_time) * 1000)
+        else:
+            # Enhance prompt using knowledge base, unless already pre-refined
+            enhanced_prompt = await prewarmer.take_prompt(request)
+            if enhanced_prompt is None:
+                enhanced_prompt = await prompt_enhancer.enhance_prompt(request.dict())
+            
+            # Generate images once the user's fair share of capacity allows
+            async with generation_scheduler.slot(request.user_id):
+                images, generation_time = await image_generator.generate_images(
+                    enhanced_prompt, generation_id, dedup=request.dedup
+                )
         
         if not images:
             raise HTTPException(
@@ -69,12 +155,20 @@ async def generate_single_image(
         
         return response
         
+    except SchedulerRejectedError as e:
+        logger.warning("Generation rejected by scheduler: %s", e)
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after) + 1)}
+        )
+    
     except ValueError as e:
-        logger.error(f"Validation error: {e}")
+        logger.error("Validation error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     
     except Exception as e:
-        logger.error(f"Generation failed: {e}")
+        logger.error("Generation failed: %s", e)
         
         # Save error to database
         background_tasks.add_task(
@@ -96,13 +190,62 @@ async def generate_single_image(
 @router.post("/batch", response_model=List[ImageGenerationResponse])
 async def generate_batch_images(
     request: BatchGenerationRequest,
-    background_tasks: BackgroundTasks
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Generate multiple images in batch"""
     
-    results = []
+    async def operation():
+        results = []
+        
+        for individual_request in request.requests:
+            try:
+                result = await _generate_single_image(individual_request, background_tasks)
+                results.append(result.dict())
+            except HTTPException as e:
+                logger.error("Batch item failed: %s", e.detail)
+        
+        return results
+    
+    if not idempotency_key:
+        results = await operation()
+    else:
+        # A batch is keyed as a whole, under the first request's user
+        user_id = request.requests[0].user_id if request.requests else "anonymous"
+        results = await run_idempotent(
+            idempotency_key, user_id, request.dict(), operation
+        )
+    
+    return [ImageGenerationResponse(**result) for result in results]
+
+@router.get("/similar/{generation_id}", response_model=SimilarityResponse)
+async def find_similar_images(
+    generation_id: str,
+    max_distance: int = Query(10, ge=0, le=64),
+    limit: int = Query(10, ge=1, le=settings.SIMILARITY_MAX_RESULTS)
+):
+    """Find images visually similar to the images of a past generation"""
+    
+    # Index scans run in a worker thread so they don't stall the event loop
+    hashes = await asyncio.to_thread(image_index.get_hashes, generation_id)
+    if not hashes:
+        raise HTTPException(status_code=404, detail="Generation not found in image index")
+    
+    # Merge matches across the generation's images, keeping the closest per image
+    best: dict = {}
+    for image_hash in hashes:
+        matches = await asyncio.to_thread(
+            image_index.search, image_hash, max_distance, limit, generation_id
+        )
+        for match in matches:
+            key = (match["generation_id"], match["hash"])
+            if key not in best or match["distance"] < best[key]["distance"]:
+                best[key] = match
+    
+    matches = sorted(best.values(), key=lambda m: m["distance"])[:limit]
     
-    for individual_request in request.requests:
-        try:
-            result = await generate_single_image(individual_request, background_tasks)
-            results.append(result)
\ No newline at end of file
+    return SimilarityResponse(
+        generation_id=generation_id,
+        matches=[SimilarImage(**match) for match in matches],
+        total_matches=len(matches)
+    )
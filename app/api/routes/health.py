@@ -0,0 +1,42 @@
+from fastapi import APIRouter
+from typing import Dict, Any
+from datetime import datetime
+import logging
+
+from app.config import settings
+from app.core.cache import cache
+from app.services.image_generator import image_generator
+from app.services.prewarmer import prewarmer
+from app.services.scheduler import generation_scheduler
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+@router.get("/")
+async def health_check():
+    """Basic liveness check"""
+    return {
+        "status": "healthy",
+        "version": settings.VERSION,
+        "timestamp": datetime.now()
+    }
+
+@router.get("/cache")
+async def cache_stats() -> Dict[str, Any]:
+    """Per-level hit rates of this worker's cache"""
+    return cache.stats()
+
+@router.get("/scheduler")
+async def scheduler_stats() -> Dict[str, Any]:
+    """Queue depth and slot usage of this worker's generation scheduler"""
+    return generation_scheduler.stats()
+
+@router.get("/prewarm")
+async def prewarm_stats() -> Dict[str, Any]:
+    """Pool size, hit counts and spend of the pre-generation worker"""
+    return await prewarmer.stats()
+
+@router.get("/replicate")
+async def replicate_batching_stats() -> Dict[str, Any]:
+    """Micro-batching efficiency of Replicate predictions"""
+    return image_generator.replicate_batcher.stats()
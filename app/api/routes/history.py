@@ -0,0 +1,33 @@
+from fastapi import APIRouter, HTTPException, Query
+from typing import Optional
+import logging
+
+from app.models.schemas import GenerationHistoryItem, GenerationHistoryPage
+from app.services.history_service import history_service
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+@router.get("/", response_model=GenerationHistoryPage)
+async def list_generation_history(
+    user_id: Optional[str] = Query(None, description="Only generations by this user"),
+    brawler: Optional[str] = Query(None, description="Only generations of this brawler"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """List past generations, newest first"""
+    
+    try:
+        summaries, next_cursor = await history_service.list_generations(
+            user_id=user_id,
+            brawler=brawler,
+            cursor=cursor,
+            limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return GenerationHistoryPage(
+        items=[GenerationHistoryItem(**summary.to_dict()) for summary in summaries],
+        next_cursor=next_cursor
+    )
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Optional, Dict
 import os
 
 class Settings(BaseSettings):
@@ -16,6 +16,8 @@ class Settings(BaseSettings):
     # AI Services
     OPENAI_API_KEY: str
     REPLICATE_API_TOKEN: str
+    REPLICATE_BATCH_WINDOW_MS: int = 50
+    REPLICATE_MAX_BATCH_SIZE: int = 4  # SDXL accepts at most 4 outputs per prediction
     
     # Social Media APIs
     REDDIT_CLIENT_ID: Optional[str] = None
@@ -27,6 +29,13 @@ class Settings(BaseSettings):
     CLOUDINARY_API_KEY: str
     CLOUDINARY_API_SECRET: str
     
+    # Logging
+    LOG_LEVEL: str = "INFO"
+    LOG_JSON: bool = True
+    LOG_INFO_SAMPLE_RATE: float = 1.0  # Fraction of INFO records kept
+    LOG_FILE: Optional[str] = None
+    LOG_QUEUE_SIZE: int = 10000
+    
     # Security
     SECRET_KEY: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
@@ -34,9 +43,50 @@ class Settings(BaseSettings):
     # Rate Limiting
     RATE_LIMIT_PER_MINUTE: int = 10
     
+    # Scheduling
+    SCHEDULER_MAX_CONCURRENT_GENERATIONS: int = 8
+    SCHEDULER_LATENCY_TARGET_MS: int = 60000
+    SCHEDULER_MAX_QUEUE_WAIT_SECONDS: int = 90
+    SCHEDULER_MAX_QUEUED_PER_USER: int = 10
+    SCHEDULER_INITIAL_SERVICE_TIME_MS: int = 20000
+    SCHEDULER_TIER_WEIGHTS: Dict[str, float] = {"free": 1.0, "standard": 2.0, "premium": 4.0}
+    SCHEDULER_USER_TIERS: Dict[str, str] = {}
+    SCHEDULER_DEFAULT_TIER: str = "standard"
+    
+    # Pre-generation of trending combinations
+    PREWARM_ENABLED: bool = False
+    PREWARM_TOP_K: int = 5
+    PREWARM_TRENDING_WINDOW_HOURS: int = 24
+    PREWARM_POOL_SIZE: int = 2  # Ready results kept per combination
+    PREWARM_POOL_TTL_SECONDS: int = 3600
+    PREWARM_INTERVAL_SECONDS: int = 30
+    PREWARM_LEASE_SECONDS: int = 90  # One worker pre-generates; lease lapses if it dies
+    PREWARM_RESERVED_SLOTS: int = 2  # Slots the lease holder leaves free in its own worker
+    PREWARM_HOURLY_BUDGET: float = 2.0  # USD, shared by all workers
+    PREWARM_COST_PER_GENERATION: float = 0.09  # DALL-E 3 HD plus one SDXL run
+    PREWARM_COST_PER_REFINEMENT: float = 0.02  # GPT-4 prompt refinement
+    
+    # Idempotency
+    IDEMPOTENCY_TTL_SECONDS: int = 86400  # Completed results kept for 24 hours
+    IDEMPOTENCY_PENDING_TTL_SECONDS: int = 600  # Frees keys held by crashed workers
+    IDEMPOTENCY_WAIT_SECONDS: int = 300
+    IDEMPOTENCY_POLL_INTERVAL_SECONDS: float = 1.0
+    
     # Caching
     REDIS_URL: Optional[str] = None
     CACHE_TTL: int = 3600  # 1 hour
+    CACHE_L1_TTL: int = 60  # Bounds staleness if an invalidation is missed
+    CACHE_L1_MAX_ENTRIES: int = 1024
+    CACHE_INVALIDATION_CHANNEL: str = "cache:invalidate"
+    # Shared memory L2, used when REDIS_URL is not set
+    CACHE_SHM_NAME: str = "brawl_stars_cache"
+    CACHE_SHM_SLOTS: int = 2048
+    CACHE_SHM_SLOT_SIZE: int = 8192
+    
+    # Image Similarity
+    IMAGE_INDEX_PATH: str = "data/phash_index.bin"
+    DEDUP_HAMMING_THRESHOLD: int = 6  # bits out of 64
+    SIMILARITY_MAX_RESULTS: int = 20
     
     class Config:
         env_file = ".env"
@@ -0,0 +1,370 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Any, Optional, List, Tuple
+import logging
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Shared memory layout: layout header, invalidation sequence, invalidation
+# ring, then slots. Bump LAYOUT_VERSION whenever the layout or the value
+# encoding changes, so segments left by an older deploy are recreated
+LAYOUT_MAGIC = b"BSC1"
+LAYOUT_VERSION = 2
+LAYOUT_HEADER = struct.Struct("<4sIQQ")  # magic, version, slots, slot size
+RING_SIZE = 256
+SEQ_FORMAT = "<Q"
+SEQ_OFFSET = 32
+RING_OFFSET = SEQ_OFFSET + 8
+SLOTS_OFFSET = RING_OFFSET + RING_SIZE * 8
+SLOT_HEADER = struct.Struct("<QdI4x")  # key hash, expires at, payload length
+
+
+def key_hash(key: str) -> int:
+    """Stable 64-bit hash of a cache key, identical in every process"""
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1  # 0 marks an empty slot
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _decode_object(value: Dict[str, Any]) -> Any:
+    if len(value) == 1 and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def dump_value(value: Any) -> bytes:
+    """Serialize a cached value; JSON, so reading L2 never executes code"""
+    return json.dumps(value, default=_encode_default, separators=(",", ":")).encode()
+
+
+def load_value(payload: bytes) -> Any:
+    return json.loads(payload, object_hook=_decode_object)
+
+
+class SharedMemoryStore:
+    """Direct-mapped key/value table in a named shared memory segment"""
+
+    def __init__(self, name: str, slots: int, slot_size: int):
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.size = SLOTS_OFFSET + slots * slot_size
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self._lock_fd: Optional[int] = None
+
+    def open(self):
+        """Create the segment, or attach if another worker already did"""
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked(fcntl.LOCK_EX):
+            try:
+                self._create()
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(self.name)
+                if not self._layout_matches():
+                    # Left by a deploy with other settings or encoding; workers
+                    # still attached keep their mapping until they restart
+                    logger.warning("Recreating shared cache %s with the current layout", self.name)
+                    self.shm.close()
+                    self.shm.unlink()
+                    self._create()
+
+        # The segment outlives any single worker; stop the resource tracker
+        # from unlinking it when the process that touched it exits
+        try:
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        except Exception:
+            pass
+
+    def close(self):
+        if self.shm:
+            self.shm.close()
+            self.shm = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        hashed = key_hash(key)
+        offset = self._slot_offset(hashed)
+
+        with self._locked(fcntl.LOCK_SH):
+            stored_hash, expires_at, length = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+            if stored_hash != hashed or expires_at < time.time():
+                return False, None
+            start = offset + SLOT_HEADER.size
+            payload = bytes(self.shm.buf[start:start + length])
+
+        stored_key, value = load_value(payload)
+        if stored_key != key:
+            return False, None
+        return True, value
+
+    def set(self, key: str, value: Any, ttl: int) -> bool:
+        payload = dump_value([key, value])
+        if len(payload) > self.slot_size - SLOT_HEADER.size:
+            return False
+
+        hashed = key_hash(key)
+        offset = self._slot_offset(hashed)
+        start = offset + SLOT_HEADER.size
+
+        with self._locked(fcntl.LOCK_EX):
+            self.shm.buf[start:start + len(payload)] = payload
+            SLOT_HEADER.pack_into(self.shm.buf, offset, hashed, time.time() + ttl, len(payload))
+        return True
+
+    def delete(self, key: str):
+        """Remove a key and record the invalidation for other workers"""
+        hashed = key_hash(key)
+        offset = self._slot_offset(hashed)
+
+        with self._locked(fcntl.LOCK_EX):
+            stored_hash, _, _ = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+            if stored_hash == hashed:
+                SLOT_HEADER.pack_into(self.shm.buf, offset, 0, 0.0, 0)
+
+            seq = struct.unpack_from(SEQ_FORMAT, self.shm.buf, SEQ_OFFSET)[0] + 1
+            struct.pack_into("<Q", self.shm.buf, RING_OFFSET + (seq % RING_SIZE) * 8, hashed)
+            struct.pack_into(SEQ_FORMAT, self.shm.buf, SEQ_OFFSET, seq)
+
+    def invalidation_seq(self) -> int:
+        return struct.unpack_from(SEQ_FORMAT, self.shm.buf, SEQ_OFFSET)[0]
+
+    def invalidations_since(self, seen: int) -> Tuple[int, Optional[List[int]]]:
+        """Key hashes invalidated after `seen`, or None if the ring overflowed"""
+        with self._locked(fcntl.LOCK_SH):
+            seq = self.invalidation_seq()
+            if seq - seen > RING_SIZE:
+                return seq, None
+            hashes = [
+                struct.unpack_from("<Q", self.shm.buf, RING_OFFSET + (s % RING_SIZE) * 8)[0]
+                for s in range(seen + 1, seq + 1)
+            ]
+        return seq, hashes
+
+    def _create(self):
+        self.shm = shared_memory.SharedMemory(self.name, create=True, size=self.size)
+        self.shm.buf[:SLOTS_OFFSET] = bytes(SLOTS_OFFSET)
+        LAYOUT_HEADER.pack_into(
+            self.shm.buf, 0, LAYOUT_MAGIC, LAYOUT_VERSION, self.slots, self.slot_size
+        )
+
+    def _layout_matches(self) -> bool:
+        if self.shm.size < self.size:
+            return False
+        header = LAYOUT_HEADER.unpack_from(self.shm.buf, 0)
+        return header == (LAYOUT_MAGIC, LAYOUT_VERSION, self.slots, self.slot_size)
+
+    def _slot_offset(self, hashed: int) -> int:
+        return SLOTS_OFFSET + (hashed % self.slots) * self.slot_size
+
+    def _locked(self, mode: int):
+        return _FileLock(self._lock_fd, mode)
+
+
+class _FileLock:
+    def __init__(self, fd: int, mode: int):
+        self.fd = fd
+        self.mode = mode
+
+    def __enter__(self):
+        fcntl.flock(self.fd, self.mode)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class TwoLevelCache:
+    """Per-process L1 in front of an L2 shared by every worker"""
+
+    def __init__(self):
+        self.l1: Dict[str, Tuple[Any, float]] = {}
+        self.l1_ttl = settings.CACHE_L1_TTL
+        self.l1_max_entries = settings.CACHE_L1_MAX_ENTRIES
+        self.redis = None
+        self.shm_store: Optional[SharedMemoryStore] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._seen_seq = 0
+        self.stats_counters = {"l1_hits": 0, "l2_hits": 0, "misses": 0}
+
+    @property
+    def backend(self) -> str:
+        if self.redis:
+            return "redis"
+        if self.shm_store:
+            return "shared_memory"
+        return "local"
+
+    async def start(self):
+        """Connect the shared tier"""
+        if settings.REDIS_URL:
+            import redis.asyncio as aioredis
+
+            self.redis = aioredis.from_url(settings.REDIS_URL)
+            self._listener = asyncio.create_task(self._listen_for_invalidations())
+        else:
+            self.shm_store = SharedMemoryStore(
+                settings.CACHE_SHM_NAME,
+                settings.CACHE_SHM_SLOTS,
+                settings.CACHE_SHM_SLOT_SIZE
+            )
+            self.shm_store.open()
+            self._seen_seq = self.shm_store.invalidation_seq()
+
+        logger.info("Cache started with %s L2", self.backend)
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self.redis:
+            await self.redis.close()
+            self.redis = None
+        if self.shm_store:
+            self.shm_store.close()
+            self.shm_store = None
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Look up a key in L1, then L2"""
+        self._apply_shm_invalidations()
+
+        entry = self.l1.get(key)
+        if entry and entry[1] > time.monotonic():
+            self.stats_counters["l1_hits"] += 1
+            return entry[0]
+        self.l1.pop(key, None)
+
+        found, value = await self._l2_get(key)
+        if found:
+            self.stats_counters["l2_hits"] += 1
+            self._l1_set(key, value, self.l1_ttl)
+            return value
+
+        self.stats_counters["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        """Store a value in both levels"""
+        ttl = ttl or settings.CACHE_TTL
+        self._l1_set(key, value, min(ttl, self.l1_ttl))
+        await self._l2_set(key, value, ttl)
+
+    async def invalidate(self, key: str):
+        """Drop a key everywhere and notify the other workers"""
+        # Catch up first; our own entry is replayed harmlessly on the next lookup
+        self._apply_shm_invalidations()
+        self.l1.pop(key, None)
+
+        if self.redis:
+            try:
+                await self.redis.delete(self._redis_key(key))
+                await self.redis.publish(settings.CACHE_INVALIDATION_CHANNEL, key)
+            except Exception as e:
+                logger.error("Redis invalidation failed for %s: %s", key, e)
+        elif self.shm_store:
+            try:
+                self.shm_store.delete(key)
+            except Exception as e:
+                logger.error("Shared cache invalidation failed for %s: %s", key, e)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit counts and rates per cache level"""
+        l1_hits = self.stats_counters["l1_hits"]
+        l2_hits = self.stats_counters["l2_hits"]
+        misses = self.stats_counters["misses"]
+        lookups = l1_hits + l2_hits + misses
+        l2_lookups = l2_hits + misses
+
+        return {
+            "backend": self.backend,
+            "l1_entries": len(self.l1),
+            "l1_hits": l1_hits,
+            "l2_hits": l2_hits,
+            "misses": misses,
+            "l1_hit_rate": l1_hits / lookups if lookups else 0.0,
+            "l2_hit_rate": l2_hits / l2_lookups if l2_lookups else 0.0,
+            "overall_hit_rate": (l1_hits + l2_hits) / lookups if lookups else 0.0
+        }
+
+    def _l1_set(self, key: str, value: Any, ttl: int):
+        if key not in self.l1 and len(self.l1) >= self.l1_max_entries:
+            self.l1.pop(next(iter(self.l1)))
+        self.l1[key] = (value, time.monotonic() + ttl)
+
+    async def _l2_get(self, key: str) -> Tuple[bool, Any]:
+        try:
+            if self.redis:
+                payload = await self.redis.get(self._redis_key(key))
+                if payload is None:
+                    return False, None
+                return True, load_value(payload)
+            if self.shm_store:
+                return self.shm_store.get(key)
+        except Exception as e:
+            logger.error("L2 cache read failed for %s: %s", key, e)
+        return False, None
+
+    async def _l2_set(self, key: str, value: Any, ttl: int):
+        try:
+            if self.redis:
+                await self.redis.set(self._redis_key(key), dump_value(value), ex=ttl)
+            elif self.shm_store:
+                if not self.shm_store.set(key, value, ttl):
+                    logger.warning("Value for %s exceeds shared cache slot size", key)
+        except Exception as e:
+            logger.error("L2 cache write failed for %s: %s", key, e)
+
+    def _apply_shm_invalidations(self):
+        """Drop L1 entries invalidated by other workers since the last check"""
+        if not self.shm_store or self.shm_store.invalidation_seq() == self._seen_seq:
+            return
+
+        self._seen_seq, hashes = self.shm_store.invalidations_since(self._seen_seq)
+        if hashes is None:
+            self.l1.clear()
+            return
+
+        invalidated = set(hashes)
+        for key in [k for k in self.l1 if key_hash(k) in invalidated]:
+            del self.l1[key]
+
+    async def _listen_for_invalidations(self):
+        """Apply invalidations published by other workers"""
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(settings.CACHE_INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.l1.pop(message["data"].decode(), None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Cache invalidation listener failed: %s", e)
+                # Anything published while disconnected was missed
+                self.l1.clear()
+                await asyncio.sleep(1)
+
+    @staticmethod
+    def _redis_key(key: str) -> str:
+        # Namespaced by encoding, so values pickled by older deploys are never read
+        return f"cache:json:{key}"
+
+
+# Global instance
+cache = TwoLevelCache()
@@ -0,0 +1,5 @@
+from app.config import settings
+from app.models.database import DatabaseManager
+
+# Global database instance
+db_manager = DatabaseManager(settings.MONGODB_URL, settings.DATABASE_NAME)
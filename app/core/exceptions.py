@@ -0,0 +1,14 @@
+class SchedulerRejectedError(Exception):
+    """Raised when a generation cannot start within its latency target"""
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class IdempotencyConflictError(Exception):
+    """Raised when an idempotency key is reused with a different request body"""
+
+
+class IdempotencyInProgressError(Exception):
+    """Raised when the request holding an idempotency key is still running elsewhere"""
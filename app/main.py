@@ -7,14 +7,21 @@ import time
 from typing import List
 
 from app.config import settings
+from app.core.cache import cache
 from app.core.database import db_manager
-from app.api.routes import generate, analytics, health
+from app.services.image_index import image_index
+from app.services.prewarmer import prewarmer
+from app.api.routes import generate, analytics, health, history
 from app.api.middleware import RateLimitMiddleware, LoggingMiddleware
+from app.utils.logger import setup_logging, shutdown_logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Configure logging; handlers run on a background thread
+setup_logging(
+    level=settings.LOG_LEVEL,
+    json_output=settings.LOG_JSON,
+    info_sample_rate=settings.LOG_INFO_SAMPLE_RATE,
+    log_file=settings.LOG_FILE,
+    queue_size=settings.LOG_QUEUE_SIZE
 )
 logger = logging.getLogger(__name__)
 
@@ -24,12 +31,18 @@ async def lifespan(app: FastAPI):
     logger.info("Starting Brawl Stars Image Generator API")
     await db_manager.connect()
     logger.info("Database connected successfully")
+    await cache.start()
+    prewarmer.start()
     
     yield
     
     # Shutdown
     logger.info("Shutting down API")
+    await prewarmer.stop()
+    image_index.flush()
+    await cache.stop()
     await db_manager.disconnect()
+    shutdown_logging()
 
 # Create FastAPI app
 app = FastAPI(
@@ -65,6 +78,12 @@ app.include_router(
     tags=["Analytics"]
 )
 
+app.include_router(
+    history.router,
+    prefix=f"{settings.API_V1_STR}/history",
+    tags=["History"]
+)
+
 app.include_router(
     health.router,
     prefix="/health",
@@ -87,5 +106,6 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=True,
-        log_level="info"
+        log_level="info",
+        log_config=None  # Keep the queue-based handlers from setup_logging
     )
\ No newline at end of file
@@ -1,5 +1,5 @@
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo import IndexModel, ASCENDING, TEXT
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
 from typing import Dict, List, Optional, Any
 from datetime import datetime
 from pydantic import BaseModel
@@ -35,6 +35,46 @@ class GenerationHistoryModel(BaseModel):
     generation_time_ms: int
     created_at: datetime
 
+class GenerationSummary:
+    """Compact generation record for list views, built from a projected document"""
+    __slots__ = (
+        "generation_id", "user_id", "brawler", "theme", "style",
+        "success", "generation_time_ms", "created_at", "image_urls"
+    )
+    
+    # Fields loaded for list views; skips enhanced_prompt and image metadata
+    PROJECTION = {
+        "_id": 0,
+        "generation_id": 1,
+        "user_input.user_id": 1,
+        "user_input.brawler": 1,
+        "user_input.theme": 1,
+        "user_input.style": 1,
+        "success": 1,
+        "generation_time_ms": 1,
+        "created_at": 1,
+        "images.cloudinary_url": 1
+    }
+    
+    def __init__(self, document: Dict[str, Any]):
+        user_input = document.get("user_input", {})
+        self.generation_id = document["generation_id"]
+        self.user_id = user_input.get("user_id")
+        self.brawler = user_input.get("brawler")
+        self.theme = user_input.get("theme")
+        self.style = user_input.get("style")
+        self.success = document.get("success", False)
+        self.generation_time_ms = document.get("generation_time_ms", 0)
+        self.created_at = document["created_at"]
+        self.image_urls = [
+            image["cloudinary_url"]
+            for image in document.get("images", [])
+            if image.get("cloudinary_url")
+        ]
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
 class DatabaseManager:
     def __init__(self, connection_string: str, database_name: str):
         self.client: AsyncIOMotorClient = None
@@ -66,8 +106,41 @@ class DatabaseManager:
             ],
             "generation_history": [
                 IndexModel([("generation_id", ASCENDING)], unique=True),
-                IndexModel([("created_at", ASCENDING)]),
-                IndexModel([("user_input.brawler", ASCENDING)])
+                # Keyset pagination on (created_at, generation_id), newest first.
+                # Their prefixes also serve plain created_at and brawler queries
+                IndexModel([("created_at", DESCENDING), ("generation_id", DESCENDING)]),
+                IndexModel([
+                    ("user_input.user_id", ASCENDING),
+                    ("created_at", DESCENDING),
+                    ("generation_id", DESCENDING)
+                ]),
+                IndexModel([
+                    ("user_input.brawler", ASCENDING),
+                    ("created_at", DESCENDING),
+                    ("generation_id", DESCENDING)
+                ]),
+                IndexModel([
+                    ("user_input.user_id", ASCENDING),
+                    ("user_input.brawler", ASCENDING),
+                    ("created_at", DESCENDING),
+                    ("generation_id", DESCENDING)
+                ])
+            ],
+            "idempotency_keys": [
+                # Documents are removed once expires_at passes
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)
+            ],
+            "prewarm_pool": [
+                IndexModel([
+                    ("combination.brawler", ASCENDING),
+                    ("combination.theme", ASCENDING),
+                    ("combination.style", ASCENDING),
+                    ("expires_at", ASCENDING)
+                ]),
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)
+            ],
+            "prewarm_budget": [
+                IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)
             ],
             "community_trends": [
                 IndexModel([("created_at", ASCENDING)]),
@@ -30,6 +30,11 @@ class GameMode(str, Enum):
     HOT_ZONE = "hot_zone"
     KNOCKOUT = "knockout"
 
+class PriorityTier(str, Enum):
+    FREE = "free"
+    STANDARD = "standard"
+    PREMIUM = "premium"
+
 class ImageGenerationRequest(BaseModel):
     brawler: str = Field(..., description="Name of the Brawl Stars character")
     theme: Theme = Field(..., description="Theme for the image")
@@ -37,6 +42,11 @@ class ImageGenerationRequest(BaseModel):
     mode: Optional[GameMode] = Field(None, description="Game mode setting")
     additional_prompt: Optional[str] = Field("", description="Additional prompt details")
     user_id: Optional[str] = Field("anonymous", description="User identifier")
+    dedup: bool = Field(
+        False,
+        description="Drop images near-identical to earlier generations; if all are, "
+                    "the least similar is kept with metadata.near_duplicate set"
+    )
     
     @validator('brawler')
     def validate_brawler_name(cls, v):
@@ -72,6 +82,32 @@ class ImageGenerationResponse(BaseModel):
     total_images: int
     created_at: datetime
 
+class SimilarImage(BaseModel):
+    generation_id: str
+    model: str
+    hash: str
+    distance: int
+
+class SimilarityResponse(BaseModel):
+    generation_id: str
+    matches: List[SimilarImage]
+    total_matches: int
+
+class GenerationHistoryItem(BaseModel):
+    generation_id: str
+    user_id: Optional[str] = None
+    brawler: Optional[str] = None
+    theme: Optional[str] = None
+    style: Optional[str] = None
+    success: bool
+    generation_time_ms: int
+    created_at: datetime
+    image_urls: List[str]
+
+class GenerationHistoryPage(BaseModel):
+    items: List[GenerationHistoryItem]
+    next_cursor: Optional[str] = None
+
 class ErrorResponse(BaseModel):
     success: bool = False
     error: str
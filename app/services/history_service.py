@@ -0,0 +1,96 @@
+import base64
+from typing import Dict, List, Optional, Any, Tuple
+from datetime import datetime
+import logging
+from app.core.database import db_manager
+from app.models.database import GenerationHistoryModel, GenerationSummary
+
+logger = logging.getLogger(__name__)
+
+# Sort order shared by every history query and its supporting indexes
+HISTORY_SORT = [("created_at", -1), ("generation_id", -1)]
+
+
+def encode_cursor(created_at: datetime, generation_id: str) -> str:
+    """Encode the last seen sort key as an opaque cursor"""
+    raw = f"{created_at.isoformat()}|{generation_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, generation_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), generation_id
+    except Exception:
+        raise ValueError("Invalid pagination cursor")
+
+
+class HistoryService:
+    async def save_generation(
+        self,
+        generation_id: str,
+        user_input: Dict[str, Any],
+        enhanced_prompt: str,
+        images: List[Dict[str, Any]],
+        success: bool,
+        error_message: Optional[str],
+        generation_time_ms: int
+    ) -> bool:
+        """Persist a generation record"""
+        try:
+            record = GenerationHistoryModel(
+                generation_id=generation_id,
+                user_input=user_input,
+                enhanced_prompt=enhanced_prompt,
+                images=images,
+                success=success,
+                error_message=error_message,
+                generation_time_ms=generation_time_ms,
+                created_at=datetime.now()
+            )
+            await db_manager.database.generation_history.insert_one(record.dict())
+            return True
+        except Exception as e:
+            logger.error("Failed to save generation %s: %s", generation_id, e)
+            return False
+    
+    async def list_generations(
+        self,
+        user_id: Optional[str] = None,
+        brawler: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = 20
+    ) -> Tuple[List[GenerationSummary], Optional[str]]:
+        """List generations newest first, resuming after the given cursor"""
+        query: Dict[str, Any] = {}
+        if user_id:
+            query["user_input.user_id"] = user_id
+        if brawler:
+            query["user_input.brawler"] = brawler.strip().title()
+        
+        # Seek past the last seen key instead of skipping, so deep pages
+        # cost the same as the first one
+        if cursor:
+            created_at, generation_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "generation_id": {"$lt": generation_id}}
+            ]
+        
+        documents = await db_manager.database.generation_history.find(
+            query, GenerationSummary.PROJECTION
+        ).sort(HISTORY_SORT).limit(limit + 1).to_list(limit + 1)
+        
+        summaries = [GenerationSummary(document) for document in documents[:limit]]
+        
+        next_cursor = None
+        if len(documents) > limit:
+            last = summaries[-1]
+            next_cursor = encode_cursor(last.created_at, last.generation_id)
+        
+        return summaries, next_cursor
+
+# Global instance
+history_service = HistoryService()
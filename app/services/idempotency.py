@@ -0,0 +1,166 @@
+import asyncio
+from typing import Dict, Any, Awaitable, Callable, Tuple
+from datetime import datetime, timedelta, timezone
+import logging
+from pymongo.errors import DuplicateKeyError
+from app.config import settings
+from app.core.database import db_manager
+from app.core.exceptions import IdempotencyConflictError, IdempotencyInProgressError
+from app.utils.helpers import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyStore:
+    def __init__(self):
+        self.ttl = timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)
+        self.pending_ttl = timedelta(seconds=settings.IDEMPOTENCY_PENDING_TTL_SECONDS)
+        # Requests running in this worker, so local retries attach without polling
+        self._inflight: Dict[str, Tuple[asyncio.Future, str]] = {}
+
+    @property
+    def collection(self):
+        return db_manager.database.idempotency_keys
+
+    async def run(
+        self,
+        key: str,
+        user_id: str,
+        payload: Dict[str, Any],
+        operation: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Run operation once per key, replaying its stored result on retries"""
+        scoped_key = f"{user_id}:{key}"
+        request_hash = fingerprint(payload)
+
+        while True:
+            inflight = self._inflight.get(scoped_key)
+            if inflight:
+                future, inflight_hash = inflight
+                if inflight_hash != request_hash:
+                    raise IdempotencyConflictError(
+                        "Idempotency key was already used with a different request"
+                    )
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    if not future.cancelled():
+                        raise
+                    continue  # Holder was cancelled; try to claim it again
+
+            if await self._claim(scoped_key, request_hash):
+                return await self._execute(scoped_key, request_hash, operation)
+
+            document = await self._wait_for_result(scoped_key)
+            if document is None:
+                continue  # Holder failed or expired; try to claim it again
+
+            if document["request_hash"] != request_hash:
+                raise IdempotencyConflictError(
+                    "Idempotency key was already used with a different request"
+                )
+            return document["response"]
+
+    async def _claim(self, scoped_key: str, request_hash: str) -> bool:
+        # TTL monitor compares against UTC; naive local times would expire early or late
+        now = datetime.now(timezone.utc)
+        try:
+            await self.collection.insert_one({
+                "_id": scoped_key,
+                "request_hash": request_hash,
+                "status": "pending",
+                "response": None,
+                "created_at": now,
+                "expires_at": now + self.pending_ttl
+            })
+            return True
+        except DuplicateKeyError:
+            existing = await self.collection.find_one({"_id": scoped_key})
+            if existing and existing["request_hash"] != request_hash:
+                raise IdempotencyConflictError(
+                    "Idempotency key was already used with a different request"
+                )
+            return False
+
+    async def _execute(
+        self,
+        scoped_key: str,
+        request_hash: str,
+        operation: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[scoped_key] = (future, request_hash)
+
+        try:
+            response = await operation()
+        except BaseException as e:
+            # Resolve local waiters before any awaited cleanup, which can fail too
+            self._inflight.pop(scoped_key, None)
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception()  # Mark retrieved when nobody attached
+            else:
+                future.cancel()
+
+            # Release the key so a retry can start over
+            try:
+                await self.collection.delete_one({"_id": scoped_key, "status": "pending"})
+            except Exception as cleanup_error:
+                logger.error(
+                    "Failed to release idempotency key %s: %s", scoped_key, cleanup_error
+                )
+            raise
+
+        # Local retries get the result even if storing it below fails
+        future.set_result(response)
+        try:
+            await self.collection.update_one(
+                {"_id": scoped_key},
+                {"$set": {
+                    "status": "completed",
+                    "response": response,
+                    "expires_at": datetime.now(timezone.utc) + self.ttl
+                }}
+            )
+        except Exception as e:
+            logger.error("Failed to store result for idempotency key %s: %s", scoped_key, e)
+        finally:
+            self._inflight.pop(scoped_key, None)
+
+        return response
+
+    async def _wait_for_result(self, scoped_key: str):
+        """Poll a key held by another worker until it completes or disappears"""
+        deadline = asyncio.get_running_loop().time() + settings.IDEMPOTENCY_WAIT_SECONDS
+
+        while True:
+            document = await self.collection.find_one({"_id": scoped_key})
+            if document is None:
+                return None
+
+            # The TTL monitor runs about once a minute; treat expired keys as gone
+            if self._as_utc(document["expires_at"]) <= datetime.now(timezone.utc):
+                await self.collection.delete_one(
+                    {"_id": scoped_key, "expires_at": document["expires_at"]}
+                )
+                return None
+
+            if document["status"] == "completed":
+                return document
+
+            if asyncio.get_running_loop().time() >= deadline:
+                raise IdempotencyInProgressError(
+                    "A request with this idempotency key is still in progress"
+                )
+            await asyncio.sleep(settings.IDEMPOTENCY_POLL_INTERVAL_SECONDS)
+
+    @staticmethod
+    def _as_utc(value: datetime) -> datetime:
+        """Mongo returns naive UTC datetimes unless the client is tz_aware"""
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
+
+
+# Global instance
+idempotency_store = IdempotencyStore()
@@ -1,25 +1,45 @@
 import asyncio
 import httpx
 import openai
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Optional, Callable, Awaitable, Set
 import time
 import logging
 from app.config import settings
 from app.services.storage_service import storage_service
+from app.services.image_index import image_index
 
 logger = logging.getLogger(__name__)
 
+STABLE_DIFFUSION_SETTINGS = {
+    "width": 1024,
+    "height": 1024,
+    "num_inference_steps": 20,
+    "guidance_scale": 7.5,
+    "scheduler": "K_EULER"
+}
+
 class ImageGenerator:
     def __init__(self):
         openai.api_key = settings.OPENAI_API_KEY
         self.replicate_token = settings.REPLICATE_API_TOKEN
+        self.replicate_batcher = ReplicateBatcher(
+            self._run_replicate_prediction,
+            settings.REPLICATE_BATCH_WINDOW_MS,
+            settings.REPLICATE_MAX_BATCH_SIZE
+        )
     
     async def generate_images(
         self, 
         enhanced_prompt: str,
-        generation_id: str
+        generation_id: str,
+        dedup: bool = False,
+        index: bool = True
     ) -> Tuple[List[Dict[str, Any]], int]:
-        """Generate images using multiple AI models"""
+        """Generate images using multiple AI models
+        
+        With index=False the images are hashed but not added to the image
+        index, for callers that index them later under another id.
+        """
         
         start_time = time.time()
         
@@ -35,12 +55,24 @@ class ImageGenerator:
         images = []
         for i, result in enumerate(results):
             if isinstance(result, Exception):
-                logger.error(f"Generation failed for model {i}: {result}")
+                logger.error("Generation failed for model %s: %s", i, result)
                 continue
             
             if result:
                 images.extend(result)
         
+        # Perceptual hashes for similarity search and dedup
+        hashes = await asyncio.gather(
+            *(image_index.compute_hash(image["url"]) for image in images)
+        )
+        for image, image_hash in zip(images, hashes):
+            image["phash"] = image_hash
+            if image_hash is not None:
+                image["metadata"]["phash"] = f"{image_hash:016x}"
+        
+        if dedup:
+            images = await self._filter_duplicates(images)
+        
         # Upload to cloud storage
         for image in images:
             try:
@@ -54,12 +86,60 @@ class ImageGenerator:
                 )
                 image["cloudinary_url"] = cloud_url
             except Exception as e:
-                logger.error(f"Failed to upload image: {e}")
+                logger.error("Failed to upload image: %s", e)
+        
+        # Index after filtering so dropped duplicates never enter the index
+        for image in images:
+            image_hash = image.pop("phash", None)
+            if image_hash is not None and index:
+                try:
+                    await image_index.add(image_hash, generation_id, image["model"])
+                except Exception as e:
+                    logger.error("Failed to index image: %s", e)
         
         generation_time = int((time.time() - start_time) * 1000)  # Convert to ms
         
         return images, generation_time
     
+    async def _filter_duplicates(self, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Drop images that are near-identical to indexed or sibling images
+        
+        If every image is a near-duplicate, the one furthest from its nearest
+        match is kept and flagged with metadata["near_duplicate"], so a paid
+        generation never comes back empty.
+        """
+        threshold = settings.DEDUP_HAMMING_THRESHOLD
+        kept = []
+        dropped = []  # (distance to nearest match, image)
+        
+        for image in images:
+            image_hash = image["phash"]
+            if image_hash is None:
+                kept.append(image)
+                continue
+            
+            # Full index scan; keep it off the event loop
+            matches = await asyncio.to_thread(image_index.search, image_hash, threshold, 1)
+            distances = [match["distance"] for match in matches] + [
+                bin(image_hash ^ other["phash"]).count("1")
+                for other in kept
+                if other["phash"] is not None
+            ]
+            nearest = min(distances, default=threshold + 1)
+            if nearest <= threshold:
+                logger.info("Dropping near-duplicate %s image", image['model'])
+                dropped.append((nearest, image))
+                continue
+            
+            kept.append(image)
+        
+        if not kept and dropped:
+            _, image = max(dropped, key=lambda entry: entry[0])
+            image["metadata"]["near_duplicate"] = True
+            kept.append(image)
+        
+        return kept
+    
     async def _generate_dalle3(self, prompt: str) -> List[Dict[str, Any]]:
         """Generate image using DALL-E 3"""
         try:
@@ -88,11 +168,32 @@ class ImageGenerator:
             return images
             
         except Exception as e:
-            logger.error(f"DALL-E 3 generation failed: {e}")
+            logger.error("DALL-E 3 generation failed: %s", e)
             return []
     
     async def _generate_stable_diffusion(self, prompt: str) -> List[Dict[str, Any]]:
         """Generate image using Stable Diffusion via Replicate"""
+        output_url = await self.replicate_batcher.submit(prompt, STABLE_DIFFUSION_SETTINGS)
+        if not output_url:
+            return []
+        
+        return [{
+            "url": output_url,
+            "model": "stable-diffusion",
+            "metadata": {
+                "model": "stable-diffusion",
+                "size": "1024x1024",
+                "steps": STABLE_DIFFUSION_SETTINGS["num_inference_steps"]
+            }
+        }]
+    
+    async def _run_replicate_prediction(
+        self,
+        prompt: str,
+        model_settings: Dict[str, Any],
+        num_outputs: int
+    ) -> List[str]:
+        """Run one Replicate prediction and return its output URLs"""
         try:
             async with httpx.AsyncClient() as client:
                 # Start prediction
@@ -106,17 +207,14 @@ class ImageGenerator:
                         "version": "ac732df83cea7fff18b8472768c88ad041fa750ff7682a21affe81863cbe77e4",
                         "input": {
                             "prompt": prompt,
-                            "width": 1024,
-                            "height": 1024,
-                            "num_inference_steps": 20,
-                            "guidance_scale": 7.5,
-                            "scheduler": "K_EULER"
+                            **model_settings,
+                            "num_outputs": num_outputs
                         }
                     }
                 )
                 
                 if response.status_code != 201:
-                    logger.error(f"Replicate API error: {response.status_code}")
+                    logger.error("Replicate API error: %s", response.status_code)
                     return []
                 
                 prediction = response.json()
@@ -136,27 +234,93 @@ class ImageGenerator:
                     status_data = status_response.json()
                     
                     if status_data["status"] == "succeeded":
-                        if status_data["output"]:
-                            return [{
-                                "url": status_data["output"][0],
-                                "model": "stable-diffusion",
-                                "metadata": {
-                                    "model": "stable-diffusion",
-                                    "size": "1024x1024",
-                                    "steps": 20
-                                }
-                            }]
-                        break
+                        return status_data["output"] or []
                     elif status_data["status"] == "failed":
-                        logger.error(f"Stable Diffusion failed: {status_data.get('error')}")
+                        logger.error("Stable Diffusion failed: %s", status_data.get('error'))
                         break
                     
                     await asyncio.sleep(5)  # Wait 5 seconds before next poll
                 
         except Exception as e:
-            logger.error(f"Stable Diffusion generation failed: {e}")
+            logger.error("Stable Diffusion generation failed: %s", e)
         
         return []
 
+class ReplicateBatcher:
+    """Coalesces concurrent identical Replicate requests into one prediction"""
+    
+    def __init__(
+        self,
+        run_prediction: Callable[[str, Dict[str, Any], int], Awaitable[List[str]]],
+        window_ms: int,
+        max_batch_size: int
+    ):
+        self.run_prediction = run_prediction
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[Tuple, List[asyncio.Future]] = {}
+        self.timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        self._flush_tasks: Set[asyncio.Task] = set()
+        self.stats_counters = {"requests": 0, "predictions": 0, "batched_requests": 0}
+    
+    async def submit(self, prompt: str, model_settings: Dict[str, Any]) -> Optional[str]:
+        """Queue one output for the prompt and wait for its URL"""
+        key = (prompt, tuple(sorted(model_settings.items())))
+        future = asyncio.get_running_loop().create_future()
+        self.stats_counters["requests"] += 1
+        
+        waiters = self.pending.setdefault(key, [])
+        waiters.append(future)
+        
+        if len(waiters) >= self.max_batch_size:
+            self._schedule_flush(key)
+        elif len(waiters) == 1:
+            self.timers[key] = asyncio.get_running_loop().call_later(
+                self.window, self._schedule_flush, key
+            )
+        
+        return await future
+    
+    def stats(self) -> Dict[str, Any]:
+        requests = self.stats_counters["requests"]
+        predictions = self.stats_counters["predictions"]
+        return {
+            "window_ms": int(self.window * 1000),
+            "max_batch_size": self.max_batch_size,
+            **self.stats_counters,
+            "predictions_saved": self.stats_counters["batched_requests"] - predictions,
+            "avg_batch_size": self.stats_counters["batched_requests"] / predictions if predictions else 0.0,
+            "pending_requests": sum(len(waiters) for waiters in self.pending.values())
+        }
+    
+    def _schedule_flush(self, key: Tuple):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        
+        waiters = self.pending.pop(key, None)
+        if not waiters:
+            return
+        
+        task = asyncio.create_task(self._flush(key, waiters))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    async def _flush(self, key: Tuple, waiters: List[asyncio.Future]):
+        prompt, model_settings = key[0], dict(key[1])
+        self.stats_counters["predictions"] += 1
+        self.stats_counters["batched_requests"] += len(waiters)
+        
+        try:
+            outputs = await self.run_prediction(prompt, model_settings, len(waiters))
+        except Exception as e:
+            logger.error("Batched Replicate prediction failed: %s", e)
+            outputs = []
+        
+        # Callers beyond the returned outputs get nothing, as a failed call would
+        for i, future in enumerate(waiters):
+            if not future.done():
+                future.set_result(outputs[i] if i < len(outputs) else None)
+
 # Global instance
-image_generator = ImageGenerator()
\ No newline at end of file
+image_generator = ImageGenerator()
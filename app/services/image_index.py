@@ -0,0 +1,235 @@
+import asyncio
+import fcntl
+import io
+import os
+import httpx
+import numpy as np
+from PIL import Image
+from typing import List, Dict, Any, Optional, Tuple
+import logging
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# On-disk layout: a fixed header followed by a flat array of records
+HEADER_DTYPE = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u4"),
+    ("count", "<u8"),
+    ("capacity", "<u8"),
+])
+HEADER_SIZE = 64
+RECORD_DTYPE = np.dtype([
+    ("hash", "<u8"),
+    ("generation_id", "S36"),
+    ("model", "S20"),
+])
+INDEX_MAGIC = b"PHIX"
+INDEX_VERSION = 1
+INITIAL_CAPACITY = 4096
+SEARCH_CHUNK_SIZE = 1 << 20  # Records scanned per vectorized pass
+
+# Fallback popcount table for NumPy releases without bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(hashes: np.ndarray, query: int) -> np.ndarray:
+    """Hamming distance between every 64-bit hash and the query hash"""
+    xored = np.bitwise_xor(hashes, np.uint64(query))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xored)
+    return _POPCOUNT_TABLE[xored.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def compute_dhash(image_bytes: bytes) -> int:
+    """Compute a 64-bit difference hash for an encoded image"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        grayscale = image.convert("L").resize((9, 8), Image.LANCZOS)
+        pixels = np.asarray(grayscale, dtype=np.int16)
+
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class ImageIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._header: Optional[np.memmap] = None
+        self._records: Optional[np.memmap] = None
+        self._lock = asyncio.Lock()
+        self._lock_fd: Optional[int] = None
+
+    @property
+    def count(self) -> int:
+        self._ensure_open()
+        return int(self._header["count"][0])
+
+    async def compute_hash(self, image_url: str) -> Optional[int]:
+        """Download an image and compute its perceptual hash"""
+        try:
+            async with httpx.AsyncClient(timeout=30) as client:
+                response = await client.get(image_url)
+                response.raise_for_status()
+
+            # Decoding and resizing is CPU bound, keep it off the event loop
+            return await asyncio.to_thread(compute_dhash, response.content)
+
+        except Exception as e:
+            logger.error("Failed to hash image %s: %s", image_url, e)
+            return None
+
+    async def add(self, image_hash: int, generation_id: str, model: str):
+        """Append a hash to the index"""
+        async with self._lock:
+            await asyncio.to_thread(self._append, image_hash, generation_id, model)
+
+    def search(
+        self,
+        image_hash: int,
+        max_distance: int,
+        limit: int,
+        exclude_generation_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Find indexed images within max_distance bits of the given hash"""
+        records, count = self._snapshot()
+        excluded = exclude_generation_id.encode() if exclude_generation_id else None
+
+        candidate_rows = []
+        candidate_distances = []
+        for start in range(0, count, SEARCH_CHUNK_SIZE):
+            chunk = records[start:min(start + SEARCH_CHUNK_SIZE, count)]
+            distances = hamming_distances(chunk["hash"], image_hash)
+            mask = distances <= max_distance
+            if excluded is not None:
+                mask &= chunk["generation_id"] != excluded
+
+            rows = np.flatnonzero(mask)
+            candidate_rows.append(rows + start)
+            candidate_distances.append(distances[rows])
+
+        if not candidate_rows:
+            return []
+
+        rows = np.concatenate(candidate_rows)
+        distances = np.concatenate(candidate_distances)
+        if len(rows) > limit:
+            nearest = np.argpartition(distances, limit - 1)[:limit]
+            rows, distances = rows[nearest], distances[nearest]
+        order = np.argsort(distances, kind="stable")
+
+        results = []
+        for row, distance in zip(rows[order], distances[order]):
+            record = records[row]
+            results.append({
+                "generation_id": record["generation_id"].decode(),
+                "model": record["model"].decode(),
+                "hash": f"{int(record['hash']):016x}",
+                "distance": int(distance)
+            })
+
+        return results
+
+    def get_hashes(self, generation_id: str) -> List[int]:
+        """Return the hashes stored for a generation"""
+        records, count = self._snapshot()
+        records = records[:count]
+        rows = np.flatnonzero(records["generation_id"] == generation_id.encode())
+        return [int(h) for h in records["hash"][rows]]
+
+    def flush(self):
+        """Flush pending writes to disk"""
+        if self._records is not None:
+            self._records.flush()
+            self._header.flush()
+
+    def _append(self, image_hash: int, generation_id: str, model: str):
+        # Every worker maps the same file, so appends and growth are
+        # serialized across processes, not just within this one
+        self._ensure_open()
+        with self._locked():
+            self._remap_if_grown()
+
+            count = int(self._header["count"][0])
+            capacity = int(self._header["capacity"][0])
+            if count >= capacity:
+                self._grow(capacity * 2)
+
+            self._records[count] = (image_hash, generation_id.encode(), model.encode())
+            self._header["count"][0] = count + 1
+
+    def _snapshot(self) -> Tuple[np.memmap, int]:
+        """Current mapping and the number of valid records in it"""
+        self._ensure_open()
+        self._remap_if_grown()
+        records = self._records
+        return records, min(int(self._header["count"][0]), len(records))
+
+    def _remap_if_grown(self):
+        """Pick up growth done by another worker"""
+        if int(self._header["capacity"][0]) != len(self._records):
+            self._open()
+
+    def _ensure_open(self):
+        if self._records is not None:
+            return
+
+        with self._locked():
+            if os.path.getsize(self.path) == 0:
+                with open(self.path, "r+b") as f:
+                    f.truncate(HEADER_SIZE + INITIAL_CAPACITY * RECORD_DTYPE.itemsize)
+                header = np.memmap(self.path, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+                header[0] = (INDEX_MAGIC, INDEX_VERSION, 0, INITIAL_CAPACITY)
+                header.flush()
+                del header
+
+            self._open()
+
+    def _open(self):
+        self._header = np.memmap(self.path, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+        if self._header["magic"][0] != INDEX_MAGIC:
+            raise ValueError(f"{self.path} is not an image hash index")
+
+        capacity = int(self._header["capacity"][0])
+        self._records = np.memmap(
+            self.path,
+            dtype=RECORD_DTYPE,
+            mode="r+",
+            offset=HEADER_SIZE,
+            shape=(capacity,)
+        )
+
+    def _grow(self, capacity: int):
+        """Extend the backing file and remap it; called with the file lock held"""
+        self.flush()
+
+        # Never shrink: other mappings may still cover the current size
+        size = HEADER_SIZE + capacity * RECORD_DTYPE.itemsize
+        with open(self.path, "r+b") as f:
+            if size > os.fstat(f.fileno()).st_size:
+                f.truncate(size)
+
+        self._header["capacity"][0] = capacity
+        self._header.flush()
+        self._open()
+
+    def _locked(self):
+        if self._lock_fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Creating the index file here lets _ensure_open size it under the lock
+            self._lock_fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return _FileLock(self._lock_fd)
+
+
+class _FileLock:
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+# Global instance
+image_index = ImageIndex(settings.IMAGE_INDEX_PATH)
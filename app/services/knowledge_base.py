@@ -1,25 +1,27 @@
 import asyncio
 from typing import Dict, List, Optional, Any
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
+from app.config import settings
+from app.core.cache import cache
 from app.core.database import db_manager
-from app.models.schemas import BrawlerModel
+from app.models.database import BrawlerModel
 
 logger = logging.getLogger(__name__)
 
 class KnowledgeBaseService:
     def __init__(self):
-        self.cache: Dict[str, Any] = {}
-        self.cache_ttl = timedelta(hours=1)
-        self.last_cache_update = {}
+        self.cache = cache
+        self.cache_ttl = settings.CACHE_TTL
     
     async def get_brawler(self, name: str) -> Optional[Dict[str, Any]]:
         """Get brawler information from knowledge base"""
         cache_key = f"brawler_{name.lower()}"
         
         # Check cache first
-        if self._is_cache_valid(cache_key):
-            return self.cache[cache_key]
+        cached = await self.cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         # Query database
         brawler = await db_manager.database.brawlers.find_one(
@@ -29,8 +31,7 @@ class KnowledgeBaseService:
         if brawler:
             # Remove MongoDB ObjectId
             brawler.pop('_id', None)
-            self.cache[cache_key] = brawler
-            self.last_cache_update[cache_key] = datetime.now()
+            await self.cache.set(cache_key, brawler, self.cache_ttl)
         
         return brawler
     
@@ -38,8 +39,9 @@ class KnowledgeBaseService:
         """Get game mode information"""
         cache_key = f"mode_{mode.lower()}"
         
-        if self._is_cache_valid(cache_key):
-            return self.cache[cache_key]
+        cached = await self.cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         game_mode = await db_manager.database.game_modes.find_one(
             {"name": {"$regex": f"^{mode.replace('_', ' ')}$", "$options": "i"}}
@@ -47,20 +49,28 @@ class KnowledgeBaseService:
         
         if game_mode:
             game_mode.pop('_id', None)
-            self.cache[cache_key] = game_mode
-            self.last_cache_update[cache_key] = datetime.now()
+            await self.cache.set(cache_key, game_mode, self.cache_ttl)
         
         return game_mode
     
-    async def get_popular_combinations(self, limit: int = 10) -> List[Dict[str, Any]]:
+    async def get_popular_combinations(
+        self,
+        limit: int = 10,
+        include_style: bool = False,
+        since: Optional[datetime] = None
+    ) -> List[Dict[str, Any]]:
         """Get popular brawler/theme combinations"""
+        group_key = {
+            "brawler": "$user_input.brawler",
+            "theme": "$user_input.theme"
+        }
+        if include_style:
+            group_key["style"] = "$user_input.style"
+        
         pipeline = [
             {
                 "$group": {
-                    "_id": {
-                        "brawler": "$user_input.brawler",
-                        "theme": "$user_input.theme"
-                    },
+                    "_id": group_key,
                     "count": {"$sum": 1},
                     "avg_rating": {"$avg": "$rating"}
                 }
@@ -68,6 +78,8 @@ class KnowledgeBaseService:
             {"$sort": {"count": -1}},
             {"$limit": limit}
         ]
+        if since:
+            pipeline.insert(0, {"$match": {"created_at": {"$gte": since}}})
         
         results = await db_manager.database.generation_history.aggregate(pipeline).to_list(limit)
         return results
@@ -81,25 +93,14 @@ class KnowledgeBaseService:
                 upsert=True
             )
             
-            # Invalidate cache
+            # Invalidate cache in every worker
             cache_key = f"brawler_{brawler_data['name'].lower()}"
-            self.cache.pop(cache_key, None)
+            await self.cache.invalidate(cache_key)
             
             return True
         except Exception as e:
-            logger.error(f"Error updating brawler data: {e}")
-            return False
-    
-    def _is_cache_valid(self, cache_key: str) -> bool:
-        """Check if cached data is still valid"""
-        if cache_key not in self.cache:
+            logger.error("Error updating brawler data: %s", e)
             return False
-        
-        last_update = self.last_cache_update.get(cache_key)
-        if not last_update:
-            return False
-        
-        return datetime.now() - last_update < self.cache_ttl
 
 # Global instance
 knowledge_base = KnowledgeBaseService()
\ No newline at end of file
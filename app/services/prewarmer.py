@@ -0,0 +1,319 @@
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Any, Tuple
+import logging
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from app.config import settings
+from app.core.cache import cache
+from app.core.database import db_manager
+from app.models.schemas import ImageGenerationRequest, PriorityTier
+from app.services.image_generator import image_generator
+from app.services.image_index import image_index
+from app.services.knowledge_base import knowledge_base
+from app.services.prompt_enhancer import prompt_enhancer
+from app.services.scheduler import generation_scheduler
+from app.utils.helpers import generate_id
+
+logger = logging.getLogger(__name__)
+
+PREWARM_USER_ID = "__prewarm__"
+LEASE_ID = "prewarmer"
+
+# (brawler, theme, style)
+CombinationKey = Tuple[str, str, str]
+
+
+class Prewarmer:
+    """Pre-generates popular combinations while providers are idle
+
+    The pool, the spend budget and the refined prompts live in shared
+    state, and a lease lets only one worker generate at a time, so N
+    workers spend one budget on one pool.
+    """
+
+    def __init__(self):
+        self.ttl = timedelta(seconds=settings.PREWARM_POOL_TTL_SECONDS)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self.stats_counters = {
+            "pool_hits": 0,
+            "prompt_hits": 0,
+            "misses": 0,
+            "generated": 0,
+            "refined": 0,
+            "failed": 0,
+            "paused": 0
+        }
+
+    @property
+    def database(self):
+        return db_manager.database
+
+    def start(self):
+        if settings.PREWARM_ENABLED and not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def take(
+        self,
+        request: ImageGenerationRequest,
+        generation_id: str
+    ) -> Optional[Dict[str, Any]]:
+        """Claim a ready result for the request, if one is pooled"""
+        key = self._request_key(request)
+        if key is None or not settings.PREWARM_ENABLED:
+            return None
+
+        # Atomic claim, so each pooled result is served at most once
+        entry = await self.database.prewarm_pool.find_one_and_delete(
+            {**self._combination_filter(key), "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            sort=[("created_at", ASCENDING)]
+        )
+        if entry is None:
+            self.stats_counters["misses"] += 1
+            return None
+
+        self.stats_counters["pool_hits"] += 1
+        # Pre-generation skipped indexing; index under the id the user sees
+        for image in entry["images"]:
+            image_hash = image["metadata"].get("phash")
+            if image_hash:
+                try:
+                    await image_index.add(int(image_hash, 16), generation_id, image["model"])
+                except Exception as e:
+                    logger.error("Failed to index pooled image: %s", e)
+        return entry
+
+    async def take_prompt(self, request: ImageGenerationRequest) -> Optional[str]:
+        """Return a pre-refined prompt for the request, if one is cached"""
+        key = self._request_key(request)
+        if key is None or not settings.PREWARM_ENABLED:
+            return None
+
+        enhanced_prompt = await cache.get(self._prompt_cache_key(key))
+        if enhanced_prompt is not None:
+            self.stats_counters["prompt_hits"] += 1
+        return enhanced_prompt
+
+    async def stats(self) -> Dict[str, Any]:
+        stats = {
+            "enabled": settings.PREWARM_ENABLED,
+            "hourly_budget": settings.PREWARM_HOURLY_BUDGET,
+            **self.stats_counters
+        }
+        if settings.PREWARM_ENABLED:
+            budget = await self.database.prewarm_budget.find_one({"_id": self._budget_window()})
+            stats["spent_this_hour"] = round(budget["spent"], 4) if budget else 0.0
+            stats["pooled_results"] = await self.database.prewarm_pool.count_documents(
+                {"expires_at": {"$gt": datetime.now(timezone.utc)}}
+            )
+        return stats
+
+    async def _run(self):
+        while True:
+            try:
+                if await self._acquire_lease():
+                    await self._prewarm_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Pre-generation pass failed: %s", e)
+            await asyncio.sleep(settings.PREWARM_INTERVAL_SECONDS)
+
+    async def _acquire_lease(self) -> bool:
+        """Take or renew the lease that lets one worker pre-generate"""
+        now = datetime.now(timezone.utc)
+        try:
+            await self.database.prewarm_lease.update_one(
+                {
+                    "_id": LEASE_ID,
+                    "$or": [{"holder": self.worker_id}, {"expires_at": {"$lte": now}}]
+                },
+                {"$set": {
+                    "holder": self.worker_id,
+                    "expires_at": now + timedelta(seconds=settings.PREWARM_LEASE_SECONDS)
+                }},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Held by another live worker; the upsert collided with its document
+            return False
+
+    async def _prewarm_once(self):
+        """Fill the pool for the current top combinations, cheapest work first"""
+        since = datetime.now() - timedelta(hours=settings.PREWARM_TRENDING_WINDOW_HOURS)
+        combinations = await knowledge_base.get_popular_combinations(
+            settings.PREWARM_TOP_K, include_style=True, since=since
+        )
+
+        for combination in combinations:
+            key = self._combination_key(combination["_id"])
+            if key is None:
+                continue
+
+            if not self._has_capacity():
+                self.stats_counters["paused"] += 1
+                return
+
+            enhanced_prompt = await self._ensure_prompt(key)
+            if enhanced_prompt is None:
+                return
+
+            while await self._pooled_count(key) < settings.PREWARM_POOL_SIZE:
+                # Renew before each generation; a long pass outlasts one lease
+                if not await self._acquire_lease():
+                    return
+                if not self._has_capacity():
+                    self.stats_counters["paused"] += 1
+                    return
+                if not await self._charge(settings.PREWARM_COST_PER_GENERATION):
+                    return
+                # Stop the pass rather than retry failing providers back to back
+                if not await self._generate(key, enhanced_prompt):
+                    return
+
+    async def _ensure_prompt(self, key: CombinationKey) -> Optional[str]:
+        cache_key = self._prompt_cache_key(key)
+        cached = await cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if not await self._charge(settings.PREWARM_COST_PER_REFINEMENT):
+            return None
+
+        brawler, theme, style = key
+        enhanced_prompt = await prompt_enhancer.enhance_prompt({
+            "brawler": brawler,
+            "theme": theme,
+            "style": style,
+            "mode": None,
+            "additional_prompt": ""
+        })
+        await cache.set(cache_key, enhanced_prompt, settings.PREWARM_POOL_TTL_SECONDS)
+        self.stats_counters["refined"] += 1
+        return enhanced_prompt
+
+    async def _generate(self, key: CombinationKey, enhanced_prompt: str) -> bool:
+        """Generate one pooled result; False if nothing was added to the pool"""
+        generation_id = generate_id()
+
+        # Traffic may have arrived while the lease and budget were awaited
+        if not self._has_capacity():
+            self.stats_counters["paused"] += 1
+            await self._refund(settings.PREWARM_COST_PER_GENERATION)
+            return False
+
+        async with generation_scheduler.slot(PREWARM_USER_ID, PriorityTier.FREE):
+            # Indexed only once served, under the id the user sees
+            images, generation_time = await image_generator.generate_images(
+                enhanced_prompt, generation_id, index=False
+            )
+
+        if not images:
+            self.stats_counters["failed"] += 1
+            logger.warning("Pre-generation for %s returned no images", "/".join(key))
+            return False
+
+        now = datetime.now(timezone.utc)
+        brawler, theme, style = key
+        await self.database.prewarm_pool.insert_one({
+            "combination": {"brawler": brawler, "theme": theme, "style": style},
+            "enhanced_prompt": enhanced_prompt,
+            "images": images,
+            "generation_time_ms": generation_time,
+            "created_at": now,
+            "expires_at": now + self.ttl
+        })
+        self.stats_counters["generated"] += 1
+        return True
+
+    async def _pooled_count(self, key: CombinationKey) -> int:
+        return await self.database.prewarm_pool.count_documents(
+            {**self._combination_filter(key), "expires_at": {"$gt": datetime.now(timezone.utc)}}
+        )
+
+    def _has_capacity(self) -> bool:
+        """Only use slots live traffic leaves idle in this worker
+
+        The check is per-worker: the lease holder cannot see requests queued
+        in the other workers' schedulers, so PREWARM_RESERVED_SLOTS has to
+        leave headroom for them.
+        """
+        return generation_scheduler.is_idle(settings.PREWARM_RESERVED_SLOTS)
+
+    async def _charge(self, cost: float) -> bool:
+        """Atomically spend from the hourly budget shared by all workers"""
+        if cost > settings.PREWARM_HOURLY_BUDGET:
+            return False
+
+        now = datetime.now(timezone.utc)
+        try:
+            # The filter only matches while the charge still fits. A missing
+            # window document is inserted; an exhausted one collides on _id
+            await self.database.prewarm_budget.update_one(
+                {
+                    "_id": self._budget_window(now),
+                    "spent": {"$lte": settings.PREWARM_HOURLY_BUDGET - cost}
+                },
+                {
+                    "$inc": {"spent": cost},
+                    "$setOnInsert": {"expires_at": now + timedelta(hours=2)}
+                },
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def _refund(self, cost: float):
+        """Return an unused charge to the current window, never below zero"""
+        await self.database.prewarm_budget.update_one(
+            {"_id": self._budget_window(), "spent": {"$gte": cost}},
+            {"$inc": {"spent": -cost}}
+        )
+
+    @staticmethod
+    def _budget_window(now: Optional[datetime] = None) -> str:
+        return (now or datetime.now(timezone.utc)).strftime("%Y-%m-%dT%H")
+
+    @staticmethod
+    def _prompt_cache_key(key: CombinationKey) -> str:
+        return "prewarm_prompt_" + "_".join(part.lower() for part in key)
+
+    @staticmethod
+    def _combination_filter(key: CombinationKey) -> Dict[str, str]:
+        brawler, theme, style = key
+        return {
+            "combination.brawler": brawler,
+            "combination.theme": theme,
+            "combination.style": style
+        }
+
+    @staticmethod
+    def _request_key(request: ImageGenerationRequest) -> Optional[CombinationKey]:
+        # Only plain requests match what was pre-generated
+        if request.mode or request.additional_prompt or request.dedup:
+            return None
+        return (request.brawler, request.theme.value, request.style.value)
+
+    @staticmethod
+    def _combination_key(combination: Dict[str, Any]) -> Optional[CombinationKey]:
+        if not all(combination.get(field) for field in ("brawler", "theme", "style")):
+            return None
+        return (combination["brawler"], combination["theme"], combination["style"])
+
+
+# Global instance
+prewarmer = Prewarmer()
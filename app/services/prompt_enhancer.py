@@ -118,7 +118,7 @@ class PromptEnhancer:
             return refined_prompt
             
         except Exception as e:
-            logger.warning(f"AI prompt refinement failed: {e}. Using base prompt.")
+            logger.warning("AI prompt refinement failed: %s. Using base prompt.", e)
             return base_prompt
 
 # Global instance
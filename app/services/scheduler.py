@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Tuple
+import logging
+from app.config import settings
+from app.core.exceptions import SchedulerRejectedError
+from app.models.schemas import PriorityTier
+
+logger = logging.getLogger(__name__)
+
+# Users whose last finish tag fell behind virtual time are dropped past this size
+MAX_TRACKED_USERS = 10000
+
+
+class _Job:
+    __slots__ = ("user_id", "start_tag", "finish_tag", "future")
+
+    def __init__(self, user_id: str, start_tag: float, finish_tag: float):
+        self.user_id = user_id
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class GenerationScheduler:
+    """Weighted fair queueing of generation slots across users"""
+
+    def __init__(self):
+        self.capacity = settings.SCHEDULER_MAX_CONCURRENT_GENERATIONS
+        self.latency_target = settings.SCHEDULER_LATENCY_TARGET_MS / 1000
+        self.max_queue_wait = settings.SCHEDULER_MAX_QUEUE_WAIT_SECONDS
+        self.max_queued_per_user = settings.SCHEDULER_MAX_QUEUED_PER_USER
+        self.avg_service_time = settings.SCHEDULER_INITIAL_SERVICE_TIME_MS / 1000
+
+        self.in_use = 0
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {}
+        self.queued_per_user: Dict[str, int] = {}
+        self._queue: List[Tuple[float, int, _Job]] = []
+        self._seq = itertools.count()
+        self.stats_counters = {"granted": 0, "enqueued": 0, "rejected": 0, "timed_out": 0}
+
+    def tier_for(self, user_id: str) -> PriorityTier:
+        tier = settings.SCHEDULER_USER_TIERS.get(user_id, settings.SCHEDULER_DEFAULT_TIER)
+        return PriorityTier(tier)
+
+    @property
+    def queued(self) -> int:
+        return sum(self.queued_per_user.values())
+
+    def is_idle(self, reserved_slots: int = 0) -> bool:
+        """True if nothing is queued and more than reserved_slots are free"""
+        return not self.queued and self.capacity - self.in_use > reserved_slots
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, tier: Optional[PriorityTier] = None):
+        """Hold a generation slot for the duration of the block"""
+        await self.acquire(user_id, tier)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    async def acquire(self, user_id: str, tier: Optional[PriorityTier] = None):
+        """Wait for a slot, in weighted fair order across users"""
+        tier = tier or self.tier_for(user_id)
+        weight = settings.SCHEDULER_TIER_WEIGHTS.get(tier.value, 1.0)
+
+        start_tag = max(self.virtual_time, self.last_finish.get(user_id, 0.0))
+        finish_tag = start_tag + 1.0 / weight
+
+        if self.in_use < self.capacity and not self.queued:
+            self.in_use += 1
+            self.last_finish[user_id] = finish_tag
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self.stats_counters["granted"] += 1
+            return
+
+        self._admit(user_id, finish_tag)
+
+        job = _Job(user_id, start_tag, finish_tag)
+        self.last_finish[user_id] = finish_tag
+        self.queued_per_user[user_id] = self.queued_per_user.get(user_id, 0) + 1
+        heapq.heappush(self._queue, (finish_tag, next(self._seq), job))
+        self.stats_counters["enqueued"] += 1
+
+        try:
+            await asyncio.wait_for(job.future, timeout=self.max_queue_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if job.future.done() and not job.future.cancelled():
+                # Granted just as the wait ended; hand the slot on
+                self.release(0.0)
+            else:
+                job.future.cancel()
+                self._dequeued(user_id)
+
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats_counters["timed_out"] += 1
+                raise SchedulerRejectedError(
+                    "Timed out waiting for generation capacity",
+                    retry_after=self.avg_service_time
+                )
+            raise
+
+    def release(self, service_time: float):
+        """Return a slot and start the next job in fair order"""
+        self.in_use -= 1
+        if service_time > 0:
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+
+        self._dispatch()
+
+        if len(self.last_finish) > MAX_TRACKED_USERS:
+            self.last_finish = {
+                user_id: tag
+                for user_id, tag in self.last_finish.items()
+                if tag > self.virtual_time or user_id in self.queued_per_user
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queued": self.queued,
+            "queued_users": len(self.queued_per_user),
+            "avg_service_time_ms": int(self.avg_service_time * 1000),
+            **self.stats_counters
+        }
+
+    def _admit(self, user_id: str, finish_tag: float):
+        """Reject work early when its queue would miss the latency target"""
+        if self.queued_per_user.get(user_id, 0) >= self.max_queued_per_user:
+            self.stats_counters["rejected"] += 1
+            raise SchedulerRejectedError(
+                "Too many queued generations for this user",
+                retry_after=self.avg_service_time
+            )
+
+        # Jobs served before this one, each freeing a slot every avg/capacity
+        ahead = sum(
+            1 for tag, _, job in self._queue
+            if tag <= finish_tag and not job.future.done()
+        )
+        estimated_wait = (ahead + 1) * self.avg_service_time / self.capacity
+
+        if estimated_wait > self.latency_target:
+            self.stats_counters["rejected"] += 1
+            raise SchedulerRejectedError(
+                f"Estimated queue wait {estimated_wait:.0f}s exceeds latency target",
+                retry_after=estimated_wait
+            )
+
+    def _dispatch(self):
+        while self.in_use < self.capacity and self._queue:
+            _, _, job = heapq.heappop(self._queue)
+            if job.future.done():
+                continue  # Timed out or cancelled while queued
+
+            self.in_use += 1
+            self.virtual_time = max(self.virtual_time, job.start_tag)
+            self._dequeued(job.user_id)
+            self.stats_counters["granted"] += 1
+            job.future.set_result(None)
+
+    def _dequeued(self, user_id: str):
+        remaining = self.queued_per_user.get(user_id, 0) - 1
+        if remaining > 0:
+            self.queued_per_user[user_id] = remaining
+        else:
+            self.queued_per_user.pop(user_id, None)
+
+
+# Global instance
+generation_scheduler = GenerationScheduler()
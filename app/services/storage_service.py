@@ -35,7 +35,7 @@ class StorageService:
             return upload_result.get("secure_url")
             
         except Exception as e:
-            logger.error(f"Failed to upload image to Cloudinary: {e}")
+            logger.error("Failed to upload image to Cloudinary: %s", e)
             return None
 
 # Global instance
@@ -0,0 +1,15 @@
+import hashlib
+import json
+import uuid
+from typing import Any
+
+
+def generate_id() -> str:
+    """Generate a unique generation id"""
+    return str(uuid.uuid4())
+
+
+def fingerprint(payload: Any) -> str:
+    """Stable SHA-256 digest of a JSON-serializable payload"""
+    encoded = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
@@ -0,0 +1,13 @@
+import os
+
+# Settings() requires these; tests never reach the real services
+for name in (
+    "MONGODB_URL",
+    "OPENAI_API_KEY",
+    "REPLICATE_API_TOKEN",
+    "CLOUDINARY_CLOUD_NAME",
+    "CLOUDINARY_API_KEY",
+    "CLOUDINARY_API_SECRET",
+    "SECRET_KEY",
+):
+    os.environ.setdefault(name, "test")
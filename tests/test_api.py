@@ -0,0 +1,45 @@
+import asyncio
+import logging
+
+from app.api.middleware import LoggingMiddleware
+
+
+def run_middleware(app, headers=()):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/api/v1/health", "headers": list(headers)}
+    asyncio.run(LoggingMiddleware(app)(scope, receive, send))
+    return sent
+
+
+def test_logging_middleware_adds_request_id_without_touching_response_headers():
+    response_headers = ((b"content-type", b"application/json"),)
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    sent = run_middleware(app, headers=[(b"x-request-id", b"req-1")])
+
+    assert (b"x-request-id", b"req-1") in sent[0]["headers"]
+    assert response_headers == ((b"content-type", b"application/json"),)
+
+
+def test_logging_middleware_logs_each_request_once(caplog):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 204})
+        await send({"type": "http.response.body", "body": b""})
+
+    with caplog.at_level(logging.INFO, logger="app.api.middleware"):
+        sent = run_middleware(app)
+
+    assert any(key == b"x-request-id" for key, _ in sent[0]["headers"])
+    (record,) = [r for r in caplog.records if r.name == "app.api.middleware"]
+    assert record.status_code == 204
+    assert record.path == "/api/v1/health"
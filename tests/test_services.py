@@ -0,0 +1,907 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from app.config import settings
+from app.core.cache import SharedMemoryStore, TwoLevelCache, dump_value, load_value
+from app.core.exceptions import (
+    IdempotencyConflictError,
+    IdempotencyInProgressError,
+    SchedulerRejectedError,
+)
+from app.models.schemas import ImageGenerationRequest, PriorityTier
+from app.services import image_index as image_index_module
+from app.services.history_service import decode_cursor, encode_cursor
+from app.services.idempotency import IdempotencyStore
+from app.services import prewarmer as prewarmer_module
+from app.services import image_generator as image_generator_module
+from app.services.image_generator import ImageGenerator, ReplicateBatcher
+from app.services.image_index import ImageIndex
+from app.services.prewarmer import Prewarmer
+from app.services.scheduler import GenerationScheduler
+from app.utils.logger import (
+    ContextFilter,
+    JsonFormatter,
+    NonBlockingQueueHandler,
+    SamplingFilter,
+    generation_id_var,
+    measure_overhead,
+    request_id_var,
+    setup_logging,
+    shutdown_logging,
+)
+
+
+# Image index
+
+def test_image_index_add_grow_and_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_index_module, "INITIAL_CAPACITY", 4)
+    index = ImageIndex(str(tmp_path / "index.bin"))
+
+    async def main():
+        for i in range(10):
+            await index.add(1 << i, f"gen{i}", "dall-e-3")
+
+    asyncio.run(main())
+
+    assert index.count == 10
+    assert index.get_hashes("gen3") == [1 << 3]
+
+    matches = index.search(1 << 3, max_distance=0, limit=5)
+    assert [m["generation_id"] for m in matches] == ["gen3"]
+
+    # Every other single-bit hash is two bits away
+    matches = index.search(1 << 3, max_distance=2, limit=20, exclude_generation_id="gen3")
+    assert len(matches) == 9
+    assert all(m["distance"] == 2 for m in matches)
+
+    reopened = ImageIndex(str(tmp_path / "index.bin"))
+    assert reopened.count == 10
+
+
+def test_image_index_handles_never_shrink_each_other(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_index_module, "INITIAL_CAPACITY", 8)
+    path = str(tmp_path / "index.bin")
+    worker_a, worker_b = ImageIndex(path), ImageIndex(path)
+
+    async def main():
+        await worker_b.add(1, "b0", "stable-diffusion")
+        for i in range(11):
+            await worker_a.add(100 + i, f"a{i}", "dall-e-3")
+        size_after_growth = os.path.getsize(path)
+
+        # B still maps the original 8 slots
+        for i in range(6):
+            await worker_b.add(200 + i, f"b{i + 1}", "stable-diffusion")
+
+        assert os.path.getsize(path) >= size_after_growth
+
+    asyncio.run(main())
+
+    assert worker_a.count == worker_b.count == 18
+    assert worker_b.get_hashes("a10") == [110]
+    assert worker_a.get_hashes("b6") == [205]
+
+
+def near_duplicates(monkeypatch, indexed_distances):
+    """Stub the index so each hash matches at the given distance"""
+    def search(image_hash, max_distance, limit, exclude_generation_id=None):
+        distance = indexed_distances.get(image_hash)
+        if distance is None or distance > max_distance:
+            return []
+        return [{"generation_id": "earlier", "distance": distance}]
+
+    monkeypatch.setattr(image_generator_module, "image_index", SimpleNamespace(search=search))
+    monkeypatch.setattr(settings, "DEDUP_HAMMING_THRESHOLD", 5)
+
+
+def generated(model, image_hash):
+    return {"model": model, "phash": image_hash, "metadata": {}}
+
+
+def test_dedup_drops_images_matching_the_index_or_siblings(monkeypatch):
+    near_duplicates(monkeypatch, {0b1: 2})
+    images = [
+        generated("dall-e-3", 0b1),
+        generated("stable-diffusion", 0xFF00),
+        generated("stable-diffusion", 0xFF01),
+        generated("dall-e-3", None)
+    ]
+
+    kept = asyncio.run(ImageGenerator()._filter_duplicates(images))
+
+    assert [image["phash"] for image in kept] == [0xFF00, None]
+    assert not any("near_duplicate" in image["metadata"] for image in kept)
+
+
+def test_dedup_keeps_least_similar_image_when_all_are_duplicates(monkeypatch):
+    near_duplicates(monkeypatch, {0b1: 1, 0b10: 4})
+    images = [generated("dall-e-3", 0b1), generated("stable-diffusion", 0b10)]
+
+    kept = asyncio.run(ImageGenerator()._filter_duplicates(images))
+
+    assert [image["phash"] for image in kept] == [0b10]
+    assert kept[0]["metadata"]["near_duplicate"] is True
+
+
+# Shared memory cache
+
+@pytest.fixture
+def shm_settings(monkeypatch):
+    monkeypatch.setattr(settings, "REDIS_URL", None)
+    monkeypatch.setattr(settings, "CACHE_SHM_NAME", f"test_cache_{os.getpid()}")
+    monkeypatch.setattr(settings, "CACHE_SHM_SLOTS", 64)
+    monkeypatch.setattr(settings, "CACHE_SHM_SLOT_SIZE", 1024)
+    yield settings
+    from multiprocessing import shared_memory
+    try:
+        shared_memory.SharedMemory(settings.CACHE_SHM_NAME).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def test_shared_cache_serves_other_workers(shm_settings):
+    async def main():
+        worker_a, worker_b = TwoLevelCache(), TwoLevelCache()
+        await worker_a.start()
+        await worker_b.start()
+
+        await worker_a.set("brawler_shelly", {"name": "Shelly"})
+        assert await worker_b.get("brawler_shelly") == {"name": "Shelly"}
+        assert worker_b.stats()["l2_hits"] == 1
+
+        await worker_a.stop()
+        await worker_b.stop()
+
+    asyncio.run(main())
+
+
+def test_shared_cache_replays_invalidations_from_other_workers(shm_settings):
+    async def main():
+        worker_a, worker_b = TwoLevelCache(), TwoLevelCache()
+        await worker_a.start()
+        await worker_b.start()
+
+        await worker_a.set("brawler_shelly", {"name": "Shelly"})
+        await worker_a.set("brawler_colt", {"name": "Colt"})
+
+        # A invalidating its own key must not skip B's earlier invalidation
+        await worker_b.invalidate("brawler_shelly")
+        await worker_a.invalidate("brawler_colt")
+
+        assert await worker_a.get("brawler_shelly") is None
+        assert await worker_a.get("brawler_colt") is None
+
+        await worker_a.stop()
+        await worker_b.stop()
+
+    asyncio.run(main())
+
+
+def test_shared_cache_round_trips_documents_as_json(shm_settings):
+    document = {"name": "Shelly", "keywords": ["shotgun"], "created_at": datetime(2026, 1, 2, 3, 4, 5)}
+    assert load_value(dump_value(document)) == document
+    assert b"Shelly" in dump_value(document)
+
+    async def main():
+        worker_a, worker_b = TwoLevelCache(), TwoLevelCache()
+        await worker_a.start()
+        await worker_b.start()
+
+        await worker_a.set("brawler_shelly", document)
+        assert await worker_b.get("brawler_shelly") == document
+
+        await worker_a.stop()
+        await worker_b.stop()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("slots, slot_size", [(64, 512), (32, 1024), (64, 1024)])
+def test_shared_memory_store_recreates_segment_with_other_layout(shm_settings, slots, slot_size):
+    name = shm_settings.CACHE_SHM_NAME
+    stale = SharedMemoryStore(name, 32, 512)
+    stale.open()
+    stale.set("brawler_shelly", {"name": "Shelly"}, 60)
+    stale.close()
+
+    store = SharedMemoryStore(name, slots, slot_size)
+    store.open()
+    try:
+        assert store.shm.size >= store.size
+        assert store.get("brawler_shelly") == (False, None)
+        store.delete("brawler_colt")  # Would index past the old segment
+        assert store.set("brawler_colt", {"name": "Colt"}, 60)
+        assert store.get("brawler_colt") == (True, {"name": "Colt"})
+    finally:
+        store.close()
+
+
+def test_shared_memory_store_recreates_segment_from_older_encoding(shm_settings):
+    from multiprocessing import shared_memory
+
+    name = shm_settings.CACHE_SHM_NAME
+    store = SharedMemoryStore(name, 64, 1024)
+    # A segment from before the layout header: all zeros except a sequence number
+    legacy = shared_memory.SharedMemory(name, create=True, size=store.size)
+    legacy.buf[:8] = (5).to_bytes(8, "little")
+    legacy.close()
+
+    store.open()
+    try:
+        assert store.invalidation_seq() == 0
+        assert store.set("brawler_shelly", {"name": "Shelly"}, 60)
+    finally:
+        store.close()
+
+
+# Scheduler
+
+def make_scheduler(capacity=1, max_queue_wait=5, latency_target=60.0):
+    scheduler = GenerationScheduler()
+    scheduler.capacity = capacity
+    scheduler.max_queue_wait = max_queue_wait
+    scheduler.latency_target = latency_target
+    scheduler.avg_service_time = 0.01
+    return scheduler
+
+
+def test_scheduler_serves_light_user_before_queued_backlog():
+    order = []
+
+    async def job(scheduler, user_id):
+        async with scheduler.slot(user_id, PriorityTier.STANDARD):
+            order.append(user_id)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        scheduler = make_scheduler(capacity=1)
+        hog = [asyncio.create_task(job(scheduler, "hog")) for _ in range(5)]
+        await asyncio.sleep(0)
+        light = asyncio.create_task(job(scheduler, "light"))
+        await asyncio.gather(*hog, light)
+
+    asyncio.run(main())
+
+    # First hog job held the slot; the light user is next despite arriving last
+    assert order[:2] == ["hog", "light"]
+    assert order.count("hog") == 5
+
+
+def test_scheduler_weights_premium_ahead_of_free():
+    order = []
+
+    async def job(scheduler, user_id, tier):
+        async with scheduler.slot(user_id, tier):
+            order.append(user_id)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        scheduler = make_scheduler(capacity=1)
+        blocker = asyncio.create_task(job(scheduler, "blocker", PriorityTier.STANDARD))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(job(scheduler, "free", PriorityTier.FREE)) for _ in range(2)]
+        tasks += [asyncio.create_task(job(scheduler, "premium", PriorityTier.PREMIUM)) for _ in range(2)]
+        await asyncio.gather(blocker, *tasks)
+
+    asyncio.run(main())
+
+    assert order[1:3] == ["premium", "premium"]
+
+
+def test_scheduler_times_out_and_leaves_queue():
+    async def main():
+        scheduler = make_scheduler(capacity=1, max_queue_wait=0.05)
+        await scheduler.acquire("holder", PriorityTier.STANDARD)
+
+        with pytest.raises(SchedulerRejectedError):
+            await scheduler.acquire("waiter", PriorityTier.STANDARD)
+
+        assert scheduler.queued == 0
+        assert scheduler.stats()["timed_out"] == 1
+
+        scheduler.release(0.01)
+        assert scheduler.in_use == 0
+
+    asyncio.run(main())
+
+
+def test_scheduler_cancelled_waiter_hands_slot_to_next():
+    async def main():
+        scheduler = make_scheduler(capacity=1)
+        await scheduler.acquire("holder", PriorityTier.STANDARD)
+
+        cancelled = asyncio.create_task(scheduler.acquire("a", PriorityTier.STANDARD))
+        waiting = asyncio.create_task(scheduler.acquire("b", PriorityTier.STANDARD))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+
+        scheduler.release(0.01)
+        await asyncio.wait_for(waiting, timeout=1)
+        assert scheduler.in_use == 1
+        assert scheduler.queued == 0
+
+    asyncio.run(main())
+
+
+def test_scheduler_rejects_when_latency_target_would_be_missed():
+    async def main():
+        scheduler = make_scheduler(capacity=1, latency_target=0.015)
+        await scheduler.acquire("holder", PriorityTier.STANDARD)
+        first = asyncio.create_task(scheduler.acquire("a", PriorityTier.STANDARD))
+        await asyncio.sleep(0)
+
+        with pytest.raises(SchedulerRejectedError):
+            await scheduler.acquire("b", PriorityTier.STANDARD)
+
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+# History cursors
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 5, 1, 12, 30, 15, 123000)
+    assert decode_cursor(encode_cursor(created_at, "gen|1")) == (created_at, "gen|1")
+
+
+@pytest.mark.parametrize("cursor", ["", "not-base64!!", "bm8tc2VwYXJhdG9y", "YWJjfGdlbg=="])
+def test_decode_cursor_rejects_bad_input(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+# Idempotency
+
+def _field(document, path):
+    value = document
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def _matches(document, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(document, branch) for branch in condition):
+                return False
+            continue
+
+        value = _field(document, key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if value is None:
+                    return False
+                if op == "$gt" and not value > operand:
+                    return False
+                if op == "$gte" and not value >= operand:
+                    return False
+                if op == "$lte" and not value <= operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCollection:
+    """The subset of a Motor collection the services use, kept in memory"""
+
+    def __init__(self):
+        self.documents = {}
+        self._ids = itertools.count()
+
+    async def insert_one(self, document):
+        document = dict(document)
+        document.setdefault("_id", next(self._ids))
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError("duplicate key")
+        self.documents[document["_id"]] = document
+
+    async def find_one(self, query):
+        matches = self._find(query)
+        return dict(matches[0]) if matches else None
+
+    async def update_one(self, query, update, upsert=False):
+        matches = self._find(query)
+        if matches:
+            document = matches[0]
+        elif upsert:
+            # Like Mongo, seed the new document from the equality fields
+            document = {
+                key: value for key, value in query.items()
+                if not key.startswith("$") and not isinstance(value, dict)
+            }
+            await self.insert_one(document)
+            document = self.documents[document["_id"]]
+            document.update(update.get("$setOnInsert", {}))
+        else:
+            return
+
+        document.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            document[key] = document.get(key, 0) + amount
+
+    async def delete_one(self, query):
+        matches = self._find(query)
+        if matches:
+            del self.documents[matches[0]["_id"]]
+
+    async def find_one_and_delete(self, query, sort=None):
+        matches = self._find(query)
+        for field, direction in reversed(sort or []):
+            matches.sort(key=lambda document: document[field], reverse=direction < 0)
+        if not matches:
+            return None
+        return self.documents.pop(matches[0]["_id"])
+
+    async def count_documents(self, query):
+        return len(self._find(query))
+
+    def _find(self, query):
+        return [document for document in self.documents.values() if _matches(document, query)]
+
+
+@pytest.fixture
+def idempotency(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(IdempotencyStore, "collection", collection)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT_SECONDS", 0.2)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_POLL_INTERVAL_SECONDS", 0.01)
+    return IdempotencyStore(), collection
+
+
+def counting_operation(result):
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        return result
+
+    return operation, calls
+
+
+def test_idempotency_replays_stored_result(idempotency):
+    store, collection = idempotency
+    operation, calls = counting_operation({"generation_id": "gen1"})
+
+    async def main():
+        first = await store.run("key", "user", {"brawler": "Shelly"}, operation)
+        second = await store.run("key", "user", {"brawler": "Shelly"}, operation)
+        return first, second
+
+    first, second = asyncio.run(main())
+
+    assert first == second == {"generation_id": "gen1"}
+    assert len(calls) == 1
+    assert collection.documents["user:key"]["status"] == "completed"
+
+
+def test_idempotency_rejects_key_reused_with_different_body(idempotency):
+    store, _ = idempotency
+    operation, _ = counting_operation({"generation_id": "gen1"})
+
+    async def main():
+        await store.run("key", "user", {"brawler": "Shelly"}, operation)
+        with pytest.raises(IdempotencyConflictError):
+            await store.run("key", "user", {"brawler": "Colt"}, operation)
+
+    asyncio.run(main())
+
+
+def test_idempotency_local_retry_attaches_to_inflight_request(idempotency):
+    store, _ = idempotency
+    release = None
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        await release.wait()
+        return {"generation_id": "gen1"}
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        first = asyncio.create_task(store.run("key", "user", {"brawler": "Shelly"}, operation))
+        await asyncio.sleep(0)
+        retry = asyncio.create_task(store.run("key", "user", {"brawler": "Shelly"}, operation))
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(first, retry)
+
+    first, retry = asyncio.run(main())
+
+    assert first == retry == {"generation_id": "gen1"}
+    assert len(calls) == 1
+    assert not store._inflight
+
+
+def test_idempotency_releases_key_after_failure(idempotency):
+    store, collection = idempotency
+
+    async def failing():
+        raise RuntimeError("provider down")
+
+    operation, calls = counting_operation({"generation_id": "gen1"})
+
+    async def main():
+        with pytest.raises(RuntimeError, match="provider down"):
+            await store.run("key", "user", {"brawler": "Shelly"}, failing)
+        assert "user:key" not in collection.documents
+        assert not store._inflight
+        return await store.run("key", "user", {"brawler": "Shelly"}, operation)
+
+    assert asyncio.run(main()) == {"generation_id": "gen1"}
+    assert len(calls) == 1
+
+
+def test_idempotency_failed_cleanup_keeps_original_error(idempotency, monkeypatch):
+    store, collection = idempotency
+
+    async def unreachable(query):
+        raise RuntimeError("mongo down")
+
+    async def failing():
+        raise ValueError("provider down")
+
+    monkeypatch.setattr(collection, "delete_one", unreachable)
+
+    async def main():
+        with pytest.raises(ValueError, match="provider down"):
+            await store.run("key", "user", {"brawler": "Shelly"}, failing)
+        assert not store._inflight
+
+        # The pending key is stuck until it expires, but a retry gives up instead of hanging
+        with pytest.raises(IdempotencyInProgressError):
+            await asyncio.wait_for(
+                store.run("key", "user", {"brawler": "Shelly"}, failing), timeout=2
+            )
+
+    asyncio.run(main())
+
+
+def test_idempotency_reclaims_expired_pending_key(idempotency):
+    store, collection = idempotency
+    operation, calls = counting_operation({"generation_id": "gen1"})
+
+    async def main():
+        # Left behind by a worker that crashed mid-request; Mongo returns naive UTC
+        await store.run("key", "user", {"brawler": "Shelly"}, operation)
+        document = collection.documents["user:key"]
+        document["status"] = "pending"
+        document["expires_at"] = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=1)
+
+        return await store.run("key", "user", {"brawler": "Shelly"}, operation)
+
+    assert asyncio.run(main()) == {"generation_id": "gen1"}
+    assert len(calls) == 2
+    assert collection.documents["user:key"]["status"] == "completed"
+
+
+# Logging
+
+def make_record(level=logging.INFO, msg="Generated %s images", args=(2,), **extra):
+    record = logging.LogRecord("app.test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_includes_extras_and_correlation_ids():
+    request_token = request_id_var.set("req-1")
+    generation_token = generation_id_var.set("gen-1")
+    try:
+        record = make_record(duration_ms=12.5)
+        ContextFilter().filter(record)
+    finally:
+        request_id_var.reset(request_token)
+        generation_id_var.reset(generation_token)
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["message"] == "Generated 2 images"
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "app.test"
+    assert entry["duration_ms"] == 12.5
+    assert entry["request_id"] == "req-1"
+    assert entry["generation_id"] == "gen-1"
+    assert "args" not in entry
+
+
+def test_queue_handler_renders_exceptions_before_enqueueing():
+    handler = NonBlockingQueueHandler(queue.Queue())
+    try:
+        raise RuntimeError("provider down")
+    except RuntimeError:
+        record = make_record(logging.ERROR, "Failed for %s", ("shelly",))
+        record.exc_info = sys.exc_info()
+
+    prepared = handler.prepare(record)
+    entry = json.loads(JsonFormatter().format(prepared))
+
+    assert prepared.exc_info is None and prepared.args is None
+    assert entry["message"] == "Failed for shelly"
+    assert "RuntimeError: provider down" in entry["exception"]
+
+
+def test_sampling_filter_keeps_warnings_and_samples_info():
+    never = SamplingFilter(0.0)
+    always = SamplingFilter(1.0)
+
+    assert not never.filter(make_record(logging.INFO))
+    assert not never.filter(make_record(logging.DEBUG))
+    assert never.filter(make_record(logging.WARNING))
+    assert never.filter(make_record(logging.ERROR))
+    assert always.filter(make_record(logging.INFO))
+
+
+def test_queue_handler_drops_records_when_full():
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=2))
+    for _ in range(5):
+        handler.handle(make_record())
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_setup_logging_leaves_access_logging_to_the_middleware():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    try:
+        setup_logging(json_output=True)
+        assert logging.getLogger("uvicorn.access").disabled
+        assert logging.getLogger("uvicorn.error").propagate
+    finally:
+        shutdown_logging()
+        root.handlers, root.level = handlers, level
+        logging.getLogger("uvicorn.access").disabled = False
+
+
+def test_logging_overhead_stays_bounded():
+    # Roughly 20µs per call unsampled and 10µs at 10% sampling on a dev
+    # machine; the bound leaves room for slow CI runners
+    assert measure_overhead(iterations=5000) < 500
+    assert measure_overhead(iterations=5000, sample_rate=0.1) < 500
+
+
+# Pre-generation
+
+@pytest.fixture
+def prewarm(monkeypatch):
+    database = SimpleNamespace(
+        prewarm_pool=FakeCollection(),
+        prewarm_budget=FakeCollection(),
+        prewarm_lease=FakeCollection()
+    )
+    monkeypatch.setattr(Prewarmer, "database", database)
+    monkeypatch.setattr(settings, "PREWARM_ENABLED", True)
+    monkeypatch.setattr(settings, "PREWARM_HOURLY_BUDGET", 1.0)
+    return Prewarmer(), database
+
+
+def plain_request(**overrides):
+    fields = {"brawler": "shelly", "theme": "space", "style": "anime", **overrides}
+    return ImageGenerationRequest(**fields)
+
+
+@pytest.mark.parametrize("overrides, expected", [
+    ({}, ("Shelly", "space", "anime")),
+    ({"mode": "showdown"}, None),
+    ({"additional_prompt": "at night"}, None),
+    ({"dedup": True}, None),
+])
+def test_prewarm_matches_only_plain_requests(overrides, expected):
+    assert Prewarmer._request_key(plain_request(**overrides)) == expected
+
+
+def test_prewarm_budget_is_charged_until_exhausted(prewarm):
+    prewarmer, database = prewarm
+
+    async def main():
+        charges = [await prewarmer._charge(0.3) for _ in range(4)]
+        assert await prewarmer._charge(0.1)
+        assert not await prewarmer._charge(1.5)
+        return charges
+
+    assert asyncio.run(main()) == [True, True, True, False]
+    (window,) = database.prewarm_budget.documents.values()
+    assert window["spent"] == pytest.approx(1.0)
+
+
+def test_prewarm_lease_is_held_by_one_worker(prewarm, monkeypatch):
+    holder, database = prewarm
+    other = Prewarmer()
+    other.worker_id = "other-host:1"
+
+    async def main():
+        assert await holder._acquire_lease()
+        assert not await other._acquire_lease()
+        assert await holder._acquire_lease()  # Renewal
+
+        # A lapsed lease goes to whoever asks next
+        database.prewarm_lease.documents["prewarmer"]["expires_at"] = (
+            datetime.now(timezone.utc) - timedelta(seconds=1)
+        )
+        assert await other._acquire_lease()
+        assert not await holder._acquire_lease()
+
+    asyncio.run(main())
+    assert database.prewarm_lease.documents["prewarmer"]["holder"] == "other-host:1"
+
+
+def test_prewarm_take_claims_each_result_once(prewarm, monkeypatch):
+    prewarmer, database = prewarm
+    indexed = []
+
+    async def add(image_hash, generation_id, model):
+        indexed.append((image_hash, generation_id, model))
+
+    monkeypatch.setattr(prewarmer_module, "image_index", SimpleNamespace(add=add))
+    now = datetime.now(timezone.utc)
+
+    def pooled(name, created_at, expires_at):
+        return {
+            "combination": {"brawler": "Shelly", "theme": "space", "style": "anime"},
+            "images": [{"model": "dall-e-3", "metadata": {"phash": "00000000000000ff"}}],
+            "name": name,
+            "created_at": created_at,
+            "expires_at": expires_at
+        }
+
+    async def main():
+        pool = database.prewarm_pool
+        await pool.insert_one(pooled("expired", now - timedelta(hours=2), now - timedelta(seconds=1)))
+        await pool.insert_one(pooled("newer", now, now + timedelta(hours=1)))
+        await pool.insert_one(pooled("older", now - timedelta(minutes=5), now + timedelta(hours=1)))
+
+        request = plain_request()
+        first = await prewarmer.take(request, "gen1")
+        second = await prewarmer.take(request, "gen2")
+        third = await prewarmer.take(request, "gen3")
+        assert await prewarmer.take(plain_request(dedup=True), "gen4") is None
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+
+    assert (first["name"], second["name"], third) == ("older", "newer", None)
+    assert indexed == [(0xff, "gen1", "dall-e-3"), (0xff, "gen2", "dall-e-3")]
+    assert prewarmer.stats_counters["pool_hits"] == 2
+    assert prewarmer.stats_counters["misses"] == 1
+
+
+def test_prewarm_pass_stops_when_generation_fails(prewarm, monkeypatch):
+    prewarmer, database = prewarm
+    generate_calls = []
+
+    async def popular(limit, include_style, since):
+        return [{"_id": {"brawler": "Shelly", "theme": "space", "style": "anime"}}]
+
+    async def generate_images(enhanced_prompt, generation_id, index=True):
+        generate_calls.append(generation_id)
+        return [], 0
+
+    async def ensure_prompt(key):
+        return "prompt"
+
+    monkeypatch.setattr(
+        prewarmer_module, "knowledge_base", SimpleNamespace(get_popular_combinations=popular)
+    )
+    monkeypatch.setattr(
+        prewarmer_module, "image_generator", SimpleNamespace(generate_images=generate_images)
+    )
+    monkeypatch.setattr(prewarmer_module, "generation_scheduler", make_scheduler(capacity=8))
+    monkeypatch.setattr(prewarmer, "_ensure_prompt", ensure_prompt)
+
+    asyncio.run(prewarmer._prewarm_once())
+
+    assert len(generate_calls) == 1
+    assert prewarmer.stats_counters["failed"] == 1
+    (window,) = database.prewarm_budget.documents.values()
+    assert window["spent"] == pytest.approx(settings.PREWARM_COST_PER_GENERATION)
+
+
+def test_prewarm_refunds_charge_when_traffic_arrives(prewarm, monkeypatch):
+    prewarmer, database = prewarm
+    scheduler = make_scheduler(capacity=8)
+    scheduler.in_use = 7
+    monkeypatch.setattr(prewarmer_module, "generation_scheduler", scheduler)
+
+    async def main():
+        assert await prewarmer._charge(settings.PREWARM_COST_PER_GENERATION)
+        return await prewarmer._generate(("Shelly", "space", "anime"), "prompt")
+
+    assert asyncio.run(main()) is False
+    assert prewarmer.stats_counters["paused"] == 1
+    (window,) = database.prewarm_budget.documents.values()
+    assert window["spent"] == pytest.approx(0.0)
+
+
+# Replicate batching
+
+def stub_prediction(outputs=None, delay=0.0):
+    calls = []
+
+    async def run_prediction(prompt, model_settings, num_outputs):
+        calls.append((prompt, model_settings, num_outputs))
+        await asyncio.sleep(delay)
+        count = num_outputs if outputs is None else outputs
+        return [f"{prompt}-{i}" for i in range(count)]
+
+    return run_prediction, calls
+
+
+def test_batcher_coalesces_identical_requests_in_order():
+    run_prediction, calls = stub_prediction()
+
+    async def main():
+        batcher = ReplicateBatcher(run_prediction, window_ms=20, max_batch_size=8)
+        results = await asyncio.gather(
+            *(batcher.submit("shelly", {"steps": 30}) for _ in range(3)),
+            batcher.submit("colt", {"steps": 30}),
+            batcher.submit("shelly", {"steps": 50})
+        )
+        return batcher, results
+
+    batcher, results = asyncio.run(main())
+
+    assert results == ["shelly-0", "shelly-1", "shelly-2", "colt-0", "shelly-0"]
+    assert sorted(call[2] for call in calls) == [1, 1, 3]
+    stats = batcher.stats()
+    assert stats["requests"] == 5
+    assert stats["predictions"] == 3
+    assert stats["batched_requests"] == 5
+    assert stats["predictions_saved"] == 2
+    assert stats["avg_batch_size"] == pytest.approx(5 / 3)
+    assert stats["pending_requests"] == 0
+
+
+def test_batcher_flushes_full_batch_before_window():
+    run_prediction, calls = stub_prediction()
+
+    async def main():
+        batcher = ReplicateBatcher(run_prediction, window_ms=10_000, max_batch_size=2)
+        return await asyncio.wait_for(
+            asyncio.gather(*(batcher.submit("shelly", {}) for _ in range(2))), timeout=1
+        )
+
+    assert asyncio.run(main()) == ["shelly-0", "shelly-1"]
+    assert calls == [("shelly", {}, 2)]
+
+
+def test_batcher_gives_none_to_callers_without_an_output():
+    run_prediction, _ = stub_prediction(outputs=1)
+
+    async def main():
+        batcher = ReplicateBatcher(run_prediction, window_ms=10, max_batch_size=8)
+        return await asyncio.gather(*(batcher.submit("shelly", {}) for _ in range(3)))
+
+    assert asyncio.run(main()) == ["shelly-0", None, None]
+
+
+def test_batcher_cancelled_caller_does_not_affect_others():
+    run_prediction, calls = stub_prediction(delay=0.01)
+
+    async def main():
+        batcher = ReplicateBatcher(run_prediction, window_ms=10, max_batch_size=8)
+        tasks = [asyncio.create_task(batcher.submit("shelly", {})) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return batcher, results
+
+    batcher, results = asyncio.run(main())
+
+    assert results[0] == "shelly-0" and results[2] == "shelly-2"
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert len(calls) == 1
+    assert batcher.stats()["pending_requests"] == 0